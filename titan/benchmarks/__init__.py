@@ -0,0 +1,5 @@
+"""
+Standalone benchmarks. Run from the directory containing manage.py, e.g.::
+
+    python -m benchmarks.referral_codes
+"""
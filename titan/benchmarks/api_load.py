@@ -0,0 +1,266 @@
+"""
+Latency, throughput and SQL statements of every referrals.urls endpoint at 10k, 100k and 1M users.
+
+A throwaway test database (as `manage.py test` would create it, from the DJANGO_SETTINGS_MODULE
+database settings) is seeded with a synthetic wait list of each size in turn, and chart files of
+--chart-days days are generated. Each endpoint then gets --requests requests from --concurrency
+threads calling the WSGI application directly, so what is measured is Django and the database, not
+an HTTP server. Every request's SQL statements are counted, except those of a streamed body (the
+export), which run after the response has been returned. Results are printed and written to
+--output as JSON, to be compared with earlier runs.
+
+    DJANGO_SETTINGS_MODULE=titan.settings python -m benchmarks.api_load --users 10000 100000
+"""
+import argparse
+import base64
+import datetime
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import urlencode
+
+import django
+import numpy as np
+
+from benchmarks import synthetic
+
+STAFF_USERNAME, STAFF_PASSWORD = 'bench-staff', 'bench-password'
+FORM = 'application/x-www-form-urlencoded'
+
+
+class Client(object):
+    """
+    Calls the WSGI application with a hand-built environ, the way a WSGI server would.
+    """
+    def __init__(self, application):
+        self.application = application
+
+    def request(self, method, path, data=None, headers=None):
+        path, _, query = path.partition('?')
+        body = urlencode(data).encode() if data else b''
+        environ = {
+            'REQUEST_METHOD': method, 'PATH_INFO': path, 'QUERY_STRING': query, 'SCRIPT_NAME': '',
+            'SERVER_NAME': 'localhost', 'SERVER_PORT': '80', 'SERVER_PROTOCOL': 'HTTP/1.1', 'REMOTE_ADDR': '127.0.0.1',
+            'CONTENT_TYPE': FORM if data else '', 'CONTENT_LENGTH': str(len(body)),
+            'wsgi.version': (1, 0), 'wsgi.url_scheme': 'http', 'wsgi.input': io.BytesIO(body),
+            'wsgi.errors': sys.stderr, 'wsgi.multithread': True, 'wsgi.multiprocess': False, 'wsgi.run_once': False,
+        }
+        environ.update(headers or {})
+        response = {}
+
+        def start_response(status, response_headers, exc_info=None):
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = response_headers
+
+        result = self.application(environ, start_response)
+        try:
+            for _ in result:
+                pass
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        return response['status'], response['headers']
+
+    def log_in(self, code):
+        _, headers = self.request('POST', '/api/user/{}/'.format(code))
+        cookies = [value.split(';', 1)[0] for name, value in headers if name == 'Set-Cookie']
+        return {'HTTP_COOKIE': '; '.join(cookies)}
+
+
+class Scenarios(object):
+    """
+    Every endpoint with a function returning the path, form data and headers of its next request.
+    Users are picked uniformly, so most of them miss the user cache, as most real visitors would.
+    """
+    def __init__(self, client, users, rng):
+        from referrals.codes import referral_code_for
+        self.client, self.users, self.rng = client, users, rng
+        self.code_for = referral_code_for
+        self.joined = 0
+        self.lock = threading.Lock()
+        self.sessions = [client.log_in(self.random_code()) for _ in range(50)]
+        self.staff = {'HTTP_AUTHORIZATION': 'Basic ' + base64.b64encode(
+            '{}:{}'.format(STAFF_USERNAME, STAFF_PASSWORD).encode()).decode()}
+
+    def random_position(self):
+        with self.lock:
+            return int(self.rng.randint(1, self.users + 1))
+
+    def random_code(self):
+        return self.code_for(self.random_position())
+
+    def new_email(self):
+        with self.lock:
+            self.joined += 1
+            return 'joined{}@bench.titan'.format(self.joined)
+
+    def all(self):
+        return [
+            ('join', 'POST', lambda: ('/api/join/', {'email': self.new_email()}, None)),
+            ('join-referral', 'POST',
+             lambda: ('/api/join/{}/'.format(self.random_code()), {'email': self.new_email()}, None)),
+            ('user', 'GET', lambda: ('/api/user/', None, self.sessions[self.random_position() % len(self.sessions)])),
+            ('user', 'DELETE', lambda: ('/api/user/', None, self.client.log_in(self.random_code()))),
+            ('user-detail', 'GET',
+             lambda: ('/api/user/detail/?' + urlencode({'email': synthetic.email_for(self.random_position())}),
+                      None, None)),
+            ('user-code', 'GET', lambda: ('/api/user/{}/'.format(self.random_code()), None, None)),
+            ('user-code', 'POST', lambda: ('/api/user/{}/'.format(self.random_code()), None, None)),
+            ('chart', 'GET', lambda: ('/api/chart/?period=' + ('YTD', '1Y', '5Y', 'ALL')[self.random_position() % 4],
+                                      None, None)),
+            ('stats', 'GET', lambda: ('/api/stats/?period=' + ('YTD', '1Y', '5Y', 'ALL')[self.random_position() % 4],
+                                      None, None)),
+            ('leaderboard', 'GET', lambda: ('/api/leaderboard/?limit=20', None, None)),
+            ('export', 'GET', lambda: ('/api/export/?output=csv', None, self.staff)),
+            ('metrics', 'GET', lambda: ('/api/metrics/', None, None)),
+        ]
+
+
+def seed(users, rng):
+    from django.contrib.auth.models import User
+    from django.core.management import call_command
+    from referrals import cache as shared_cache, ranking
+    from referrals.management.commands.import_registrations import insert_users
+    from referrals.models import CounterShard, Sequence
+
+    call_command('flush', interactive=False, verbosity=0)
+    # ids follow insertion order on the freshly flushed table, matching the chunks' explicit ones
+    for chunk in synthetic.users(users, rng):
+        insert_users(chunk)
+    Sequence.set_value(Sequence.WAIT_LIST, users)
+    CounterShard.set_value(CounterShard.TOTAL_REGISTERED, users)
+    User.objects.create_superuser(STAFF_USERNAME, 'staff@bench.titan', STAFF_PASSWORD)
+    shared_cache.get_cache().clear()
+    ranking.reset()
+
+
+def run(client, method, request, count, concurrency):
+    """
+    (latencies, SQL statement counts, statuses) of `count` requests spread over `concurrency` threads.
+    """
+    from django.db import connections
+    from referrals import metrics
+
+    latencies, statements, statuses = [], [], []
+    lock = threading.Lock()
+    shares = [count // concurrency + (index < count % concurrency) for index in range(concurrency)]
+
+    def worker(share):
+        measured = []
+        for _ in range(share):
+            path, data, headers = request()
+            started = time.perf_counter()
+            status, _ = client.request(method, path, data, headers)
+            measured.append((time.perf_counter() - started, metrics.state.sql_statements, status))
+        connections.close_all()
+        with lock:
+            for latency, statement_count, status in measured:
+                latencies.append(latency)
+                statements.append(statement_count)
+                statuses.append(status)
+
+    threads = [threading.Thread(target=worker, args=(share,)) for share in shares if share]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, statements, statuses, time.perf_counter() - started
+
+
+def summarize(latencies, statements, statuses, elapsed):
+    p50, p95, p99 = np.percentile(np.array(latencies) * 1e3, [50, 95, 99])
+    return {
+        'requests': len(latencies),
+        'errors': sum(1 for status in statuses if status >= 400),
+        'statuses': {str(status): statuses.count(status) for status in sorted(set(statuses))},
+        'p50_ms': round(p50, 3), 'p95_ms': round(p95, 3), 'p99_ms': round(p99, 3),
+        'throughput_rps': round(len(latencies) / elapsed, 1),
+        'sql_statements_mean': round(float(np.mean(statements)), 2),
+        'sql_statements_max': int(max(statements)),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, nargs='+', default=[10 ** 4, 10 ** 5, 10 ** 6])
+    parser.add_argument('--requests', type=int, default=500, help='requests per endpoint')
+    parser.add_argument('--export-requests', type=int, default=3, help='requests of the full export')
+    parser.add_argument('--concurrency', type=int, default=4, help='threads sending requests')
+    parser.add_argument('--chart-days', type=int, default=2520, help='weekdays in the generated chart file')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='benchmark-results.json')
+    args = parser.parse_args()
+
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'titan.settings')
+    django.setup()
+    from django.core.wsgi import get_wsgi_application
+    from django.db import connection
+    from django.test.utils import override_settings
+
+    directory = tempfile.mkdtemp()
+    chart_path = os.path.join(directory, 'chart.csv')
+    synthetic.write_chart_file(chart_path, args.chart_days, np.random.RandomState(args.seed))
+    override_settings(
+        DEBUG=False, ALLOWED_HOSTS=['localhost'], DATABASE_REPLICAS=[], METRICS_ENABLED=True, METRICS_SQL_SAMPLE_RATE=1,
+        PATH_TO_CSV_CHART=chart_path,
+        CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}, SHARED_CACHE_ALIAS='default',
+        # Basic auth of the export would otherwise be dominated by PBKDF2
+        PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'],
+    ).enable()
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+
+    results = {
+        'started': datetime.datetime.utcnow().isoformat() + 'Z',
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'database': connection.vendor,
+        'settings': os.environ['DJANGO_SETTINGS_MODULE'],
+        'arguments': vars(args),
+        'runs': [],
+    }
+    try:
+        client = Client(get_wsgi_application())
+        for users in args.users:
+            rng = np.random.RandomState(args.seed)
+            started = time.perf_counter()
+            seed(users, rng)
+            run_result = {'users': users, 'seed_seconds': round(time.perf_counter() - started, 1), 'endpoints': {}}
+            print('{:,} users seeded in {} s'.format(users, run_result['seed_seconds']))
+            print('{:<22} {:>8} {:>9} {:>9} {:>9} {:>9} {:>8} {:>7}'.format(
+                'endpoint', 'requests', 'p50 ms', 'p95 ms', 'p99 ms', 'req/s', 'sql avg', 'errors'))
+            scenarios = Scenarios(client, users, rng)
+            for route, method, request in scenarios.all():
+                count = args.export_requests if route == 'export' else args.requests
+                summary = summarize(*run(client, method, request, count, args.concurrency))
+                name = '{} {}'.format(method, route)
+                run_result['endpoints'][name] = summary
+                print('{:<22} {requests:>8} {p50_ms:>9.2f} {p95_ms:>9.2f} {p99_ms:>9.2f} {throughput_rps:>9.1f} '
+                      '{sql_statements_mean:>8.1f} {errors:>7}'.format(name, **summary))
+            results['runs'].append(run_result)
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        os.remove(chart_path)
+        os.rmdir(directory)
+
+    with open(args.output, 'w') as output:
+        json.dump(results, output, indent=2)
+    print('results written to {}'.format(args.output))
+
+
+if __name__ == '__main__':
+    main()
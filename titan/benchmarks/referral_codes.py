@@ -0,0 +1,32 @@
+"""
+Shows that issuing a referral code costs the same at 10M+ users as at 1k: a code is a pure
+function of the wait-list position, no lookups involved.
+"""
+import argparse
+import time
+
+from referrals.codes import referral_code_for
+
+KEY = b'benchmark-key'
+
+
+def measure(start, count):
+    began = time.perf_counter()
+    codes = {referral_code_for(position, key=KEY) for position in range(start, start + count)}
+    elapsed = time.perf_counter() - began
+    assert len(codes) == count, 'duplicate codes issued'
+    return elapsed / count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--count', type=int, default=100000, help='codes issued per band')
+    args = parser.parse_args()
+
+    print('{:>14} {:>14}'.format('position', 'us per code'))
+    for start in (1, 10 ** 3, 10 ** 6, 10 ** 7, 10 ** 8, 10 ** 9):
+        print('{:>14,} {:>14.2f}'.format(start, measure(start, args.count) * 1e6))
+
+
+if __name__ == '__main__':
+    main()
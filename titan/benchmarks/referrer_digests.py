@@ -0,0 +1,86 @@
+"""
+Render and send cost of notifying one referrer about a burst of referrals: one email per referral
+(rendering both templates through the loader each time, as before digests) versus a single digest.
+Emails go to the in-memory backend, so only Django's own work is measured.
+"""
+import argparse
+import os
+import time
+
+import django
+from django.conf import settings
+
+TEMPLATES_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'templates')
+
+
+def setup():
+    settings.configure(
+        INSTALLED_APPS=['referrals'],
+        TEMPLATES=[{
+            'BACKEND': 'django.template.backends.django.DjangoTemplates',
+            'DIRS': [TEMPLATES_DIR],
+            'OPTIONS': {'debug': True},
+        }],
+        EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend',
+    )
+    django.setup()
+
+
+def send(subject, text, html, recipient, connection=None):
+    from django.core.mail import EmailMultiAlternatives
+    email = EmailMultiAlternatives(subject, text, None, [recipient], connection=connection)
+    email.attach_alternative(html, 'text/html')
+    email.send()
+
+
+def per_referral(referrals, context):
+    from django.template.loader import render_to_string
+    for _ in range(referrals):
+        send('Thank you!',
+             render_to_string('email-titan-template-after-signup.txt', context),
+             render_to_string('email-titan-template-after-signup.html', context),
+             'referrer@email.com')
+
+
+def per_referral_compiled_once(referrals, context):
+    from referrals.emails import render_to_string
+    for _ in range(referrals):
+        send('Thank you!',
+             render_to_string('email-titan-template-after-signup.txt', context),
+             render_to_string('email-titan-template-after-signup.html', context),
+             'referrer@email.com')
+
+
+def digest(referrals, context):
+    from referrals.emails import render_to_string
+    context = dict(context, referrals=referrals)
+    send('Thank you!',
+         render_to_string('email-titan-template-after-signup.txt', context),
+         render_to_string('email-titan-template-after-signup.html', context),
+         'referrer@email.com')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--referrals', type=int, default=10000)
+    args = parser.parse_args()
+
+    setup()
+    from django.core import mail
+    context = {'status_url': 'https://titan/#!/check-status/referrer@email.com', 'logo_url': 'https://titan/images/Titan_logo.png'}
+
+    strategies = (
+        ('per referral', per_referral),
+        ('compiled once', per_referral_compiled_once),
+        ('digest', digest),
+    )
+    for name, strategy in strategies:
+        mail.outbox = []
+        began = time.perf_counter()
+        strategy(args.referrals, context)
+        elapsed = time.perf_counter() - began
+        print('{:<14} {:>8} emails {:>10.3f} s'.format(name, len(mail.outbox), elapsed))
+
+
+if __name__ == '__main__':
+    main()
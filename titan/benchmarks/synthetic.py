@@ -0,0 +1,109 @@
+"""
+Synthetic data for the benchmarks: a wait list with a realistic referral tree, and chart files of
+any length. Everything is drawn from a seeded RandomState, so a given seed always produces
+the same users and series.
+"""
+import datetime
+
+import numpy as np
+
+# Share of users who joined through somebody's referral link
+REFERRED_SHARE = 0.45
+# Share of referred users whose referrer is drawn in proportion to the referrals they already have,
+# which gives the heavy-tailed referral counts of real wait lists; the others pick anybody
+PREFERENTIAL_SHARE = 0.7
+CHUNK_SIZE = 50000
+
+
+def email_for(position):
+    return 'user{}@bench.titan'.format(position)
+
+
+def referral_tree(users, rng):
+    """
+    Index of each user's referrer (-1 for none), referrers always joining before the users they
+    referred.
+    """
+    referrers = np.full(users, -1, dtype=np.int64)
+    referred = rng.random_sample(users) < REFERRED_SHARE
+    preferential = rng.random_sample(users) < PREFERENTIAL_SHARE
+    draws = rng.random_sample(users)
+    credited = []
+    for index in range(1, users):
+        if not referred[index]:
+            continue
+        if preferential[index] and credited:
+            referrer = credited[int(draws[index] * len(credited))]
+        else:
+            referrer = int(draws[index] * index)
+        referrers[index] = referrer
+        credited.append(referrer)
+    return referrers
+
+
+def tree_stats(referrers):
+    """
+    (referral_count, descendant_count, depth) arrays of the tree given by `referral_tree`.
+    """
+    users = len(referrers)
+    referral_counts = np.bincount(referrers[referrers >= 0], minlength=users)
+    depths = np.zeros(users, dtype=np.int64)
+    for index in np.flatnonzero(referrers >= 0):
+        depths[index] = depths[referrers[index]] + 1
+    descendants = np.zeros(users, dtype=np.int64)
+    # deepest level first, so every subtree is complete before it is added to its root
+    for depth in range(int(depths.max()) if users else 0, 0, -1):
+        level = np.flatnonzero(depths == depth)
+        np.add.at(descendants, referrers[level], descendants[level] + 1)
+    return referral_counts, descendants, depths
+
+
+def users(count, rng):
+    """
+    Unsaved RegisteredUser instances with ids and positions 1..count, in chunks of CHUNK_SIZE, with
+    every denormalized counter (referral_count, referral_path, depth, descendant_count) filled in.
+    """
+    from referrals.codes import referral_code_for
+    from referrals.models import RegisteredUser
+
+    referrers = referral_tree(count, rng)
+    referral_counts, descendants, depths = tree_stats(referrers)
+    paths = [''] * count
+    for start in range(0, count, CHUNK_SIZE):
+        chunk = []
+        for index in range(start, min(start + CHUNK_SIZE, count)):
+            position = index + 1
+            user = RegisteredUser(pk=position, email=email_for(position), wait_list_position=position,
+                                  referral_code=referral_code_for(position),
+                                  referral_count=int(referral_counts[index]), depth=int(depths[index]),
+                                  descendant_count=int(descendants[index]))
+            referrer = int(referrers[index])
+            if referrer >= 0:
+                user.referred_by_id = referrer + 1
+                paths[index] = user.referral_path = '{}{}/'.format(paths[referrer], referrer + 1)
+            chunk.append(user)
+        yield chunk
+
+
+def chart_rows(days, rng, end=None):
+    """
+    The three rows of a chart file: `days` weekdays ending at `end` (today by default), then Titan
+    and S&P 500 as random walks starting at 100.
+    """
+    date = end or datetime.date.today()
+    dates = []
+    while len(dates) < days:
+        if date.weekday() < 5:
+            dates.append(date)
+        date -= datetime.timedelta(days=1)
+    dates.reverse()
+    titan = 100 * np.cumprod(1 + rng.normal(0.0005, 0.012, days))
+    sp500 = 100 * np.cumprod(1 + rng.normal(0.0003, 0.01, days))
+    return (['Date'] + [date.strftime('%m/%d/%Y') for date in dates],
+            ['Titan'] + ['{:.2f}'.format(value) for value in titan],
+            ['S&P 500'] + ['{:.2f}'.format(value) for value in sp500])
+
+
+def write_chart_file(path, days, rng):
+    with open(path, 'w') as output:
+        output.write(''.join(','.join(row) + '\n' for row in chart_rows(days, rng)))
@@ -0,0 +1,69 @@
+"""
+Cost of the referral-boosted wait list (referrals.ranking.RankIndex) at 1M users: building the
+index, then bursts of traffic where a handful of viral referrers collect most referrals while new
+users keep joining, each event followed by a rank query as an API response would need. A full
+re-sort per query is timed once for comparison.
+"""
+import argparse
+import time
+
+import django
+import numpy as np
+from django.conf import settings
+
+
+def percentiles(samples):
+    return np.percentile(np.array(samples) * 1e6, [50, 95, 99])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--users', type=int, default=10 ** 6)
+    parser.add_argument('--bursts', type=int, default=20)
+    parser.add_argument('--burst-size', type=int, default=5000, help='events per burst')
+    parser.add_argument('--boost', type=int, default=10)
+    args = parser.parse_args()
+    settings.configure(INSTALLED_APPS=['referrals'])
+    django.setup()
+    from referrals.ranking import RankIndex
+    rng = np.random.RandomState(0)
+
+    positions = np.arange(1, args.users + 1)
+    referral_counts = np.minimum(rng.zipf(2.0, args.users) - 1, 10 ** 4)
+    began = time.perf_counter()
+    index = RankIndex(args.boost, positions, referral_counts)
+    print('build {:,} users: {:.2f} s'.format(args.users, time.perf_counter() - began))
+
+    counts = dict(enumerate(referral_counts.tolist(), 1))
+    next_position = args.users + 1
+    updates, queries = [], []
+    for _ in range(args.bursts):
+        viral = rng.randint(1, next_position, size=5).tolist()
+        for _ in range(args.burst_size):
+            # every event is a new user; most of them were referred by one of the viral users
+            referrer = viral[rng.randint(5)] if rng.rand() < 0.8 else rng.randint(1, next_position)
+            started = time.perf_counter()
+            index.set(next_position, 0)
+            counts[referrer] += 1
+            index.set(referrer, counts[referrer])
+            updates.append(time.perf_counter() - started)
+            counts[next_position] = 0
+            next_position += 1
+
+            started = time.perf_counter()
+            index.rank(referrer, counts[referrer])
+            queries.append(time.perf_counter() - started)
+
+    print('{:>24} {:>10} {:>10} {:>10}'.format('us per operation', 'p50', 'p95', 'p99'))
+    print('{:>24} {:>10.1f} {:>10.1f} {:>10.1f}'.format('join + credit referrer', *percentiles(updates)))
+    print('{:>24} {:>10.1f} {:>10.1f} {:>10.1f}'.format('rank query', *percentiles(queries)))
+
+    all_positions = np.fromiter(counts.keys(), dtype=np.int64, count=len(counts))
+    all_counts = np.fromiter(counts.values(), dtype=np.int64, count=len(counts))
+    started = time.perf_counter()
+    np.lexsort((all_positions, all_positions - args.boost * all_counts))
+    print('full re-sort for comparison: {:.0f} ms'.format((time.perf_counter() - started) * 1e3))
+
+
+if __name__ == '__main__':
+    main()
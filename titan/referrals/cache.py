@@ -0,0 +1,112 @@
+"""
+Cache shared by all workers of a node (the `SHARED_CACHE_ALIAS` entry of CACHES, file based by
+default, Redis in larger deployments) with single-flight recomputation: when an entry is missing
+only one request computes it while the others wait for the result, and when it is merely stale the
+others keep getting the stale value until it has been refreshed.
+
+Locks rely on `cache.add`, which is atomic on Redis and memcached but only best effort on the file
+based cache, where two workers may occasionally both recompute.
+
+User payloads are cached here as well, under their referral code and their email, and replaced by
+CHANGED whenever one of their fields changes (see `invalidate_user`).
+"""
+import hashlib
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+
+LOCK_SUFFIX = ':lock'
+POLL_INTERVAL = 0.05
+
+# Hits, misses and invalidations of the user payload cache in this process.
+user_cache_stats = Counter()
+
+# Left in place of an invalidated user payload for REPLICA_PIN_SECONDS: the next read must come from
+# the primary, as replicas may not have the change yet.
+CHANGED = 'changed'
+
+
+def get_cache():
+    return caches[getattr(settings, 'SHARED_CACHE_ALIAS', 'default')]
+
+
+def get_or_compute(key, compute, ttl, stale_ttl=0, lock_timeout=10):
+    """
+    Returns the value cached under `key`, computing it with `compute()` when needed. Values are fresh
+    for `ttl` seconds and may then be served stale for `stale_ttl` more seconds while one request
+    refreshes them.
+    """
+    cache = get_cache()
+    entry = cache.get(key)
+    if entry is not None:
+        value, fresh_until = entry
+        if time.time() < fresh_until or not _acquire(cache, key, lock_timeout):
+            return value
+        return _refresh(cache, key, compute, ttl, stale_ttl)
+
+    if _acquire(cache, key, lock_timeout):
+        return _refresh(cache, key, compute, ttl, stale_ttl)
+
+    deadline = time.time() + lock_timeout
+    while time.time() < deadline:
+        time.sleep(POLL_INTERVAL)
+        entry = cache.get(key)
+        if entry is not None:
+            return entry[0]
+    # Whoever held the lock is gone without storing anything.
+    return compute()
+
+
+def _acquire(cache, key, lock_timeout):
+    return cache.add(key + LOCK_SUFFIX, True, lock_timeout)
+
+
+def _refresh(cache, key, compute, ttl, stale_ttl):
+    try:
+        value = compute()
+        cache.set(key, (value, time.time() + ttl), ttl + stale_ttl)
+        return value
+    finally:
+        cache.delete(key + LOCK_SUFFIX)
+
+
+def user_key(field, value):
+    if field == 'email':
+        value = hashlib.sha1(value.encode()).hexdigest()
+    return 'referrals:user:{}:{}'.format(field, value)
+
+
+def get_user(field, value):
+    """
+    Cached payload of the user whose `field` ('referral_code' or 'email') is `value`, None or CHANGED.
+    """
+    data = get_cache().get(user_key(field, value))
+    user_cache_stats['misses' if data is None or data == CHANGED else 'hits'] += 1
+    return data
+
+
+def set_user(data):
+    """
+    Caches a payload just read from the database, with `cache.add` so that it never replaces CHANGED:
+    the row may have been read before that change committed.
+    """
+    cache = get_cache()
+    ttl = getattr(settings, 'USER_CACHE_TTL', 300)
+    cache.add(user_key('referral_code', data['referral_code']), data, ttl)
+    cache.add(user_key('email', data['email']), data, ttl)
+
+
+def invalidate_user(user):
+    """
+    Replaces the cached payload of `user` by CHANGED, now and again when the current transaction
+    commits. A request that read the old row before the commit cannot fill the cache while CHANGED is
+    there, so it could only put the old payload back if it took more than REPLICA_PIN_SECONDS.
+    """
+    changed = dict.fromkeys([user_key('referral_code', user.referral_code), user_key('email', user.email)], CHANGED)
+    ttl = getattr(settings, 'REPLICA_PIN_SECONDS', 5)
+    get_cache().set_many(changed, ttl)
+    transaction.on_commit(lambda: get_cache().set_many(changed, ttl))
+    user_cache_stats['invalidations'] += 1
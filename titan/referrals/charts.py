@@ -0,0 +1,399 @@
+"""
+The chart master series is parsed once per process into NumPy arrays and kept together with
+serialized (and gzipped) JSON for the ranges that were requested. The file is read again only when
+its mtime or size changes, checked at most every CHART_RELOAD_INTERVAL seconds.
+
+With PATH_TO_CHART_STORE set, the series is read from a chart store built by build_chart_store
+instead: the arrays are memory-mapped read-only views of the file, so all workers of a node share
+its pages and nothing is parsed.
+
+Every chart period is a slice of the master series found by binary search on its sorted timestamps,
+and the stats of a period are computed from that slice.
+"""
+import base64
+import csv
+import datetime
+import gzip
+import hashlib
+import io
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+from django.conf import settings
+
+from referrals import cache as shared_cache
+
+logger = logging.getLogger(__name__)
+
+EPOCH = datetime.date(1970, 1, 1)
+DAY = 86400
+YEAR = 365.25 * DAY
+
+PERIODS = ('YTD', '1Y', '3Y', '5Y', '10Y', 'ALL')
+
+# Chart store layout: this header, then `count` int64 labels, `count` float64 Titan values and `count`
+# float64 S&P 500 values, all little endian
+STORE_HEADER = struct.Struct('<8sI4xQ16s')
+STORE_MAGIC = b'TITANCHT'
+STORE_VERSION = 1
+STORE_DTYPES = ('<i8', '<f8', '<f8')
+
+# Compact chart responses carry every column as base64 encoded little-endian values of these types,
+# labels delta-encoded. Labels are signed 64-bit: the first one is an absolute timestamp, which may be
+# before 1970 or after 2038.
+COMPACT_MEDIA_TYPE = 'application/vnd.titan.compact+json'
+COMPACT_DTYPES = (('labels', '<i8'), ('titan', '<f4'), ('sp500', '<f4'))
+# Part of the ETag, so that neither clients nor the shared cache keep bodies of an older encoding
+COMPACT_VERSION = 2
+
+STAT_LABELS = ('Total return', 'Annualized return', 'Volatility', 'Max drawdown', 'Sharpe ratio', 'Best month',
+               'Worst month')
+
+
+def parse_date(label):
+    """
+    '%m/%d/%Y' to a unix timestamp, without going through strptime.
+    """
+    month, day, year = label.split('/')
+    return (datetime.date(int(year), int(month), int(day)) - EPOCH).days * DAY
+
+
+def to_timestamp(date):
+    return (date - EPOCH).days * DAY
+
+
+def period_start(period, end):
+    """
+    Timestamp of the first day of `period` ending at timestamp `end`, None for the whole series.
+    """
+    if period == 'ALL':
+        return None
+    end_date = EPOCH + datetime.timedelta(days=end // DAY)
+    if period == 'YTD':
+        return to_timestamp(datetime.date(end_date.year, 1, 1))
+    year = end_date.year - int(period[:-1])
+    try:
+        return to_timestamp(end_date.replace(year=year))
+    except ValueError:
+        return to_timestamp(end_date.replace(year=year, day=28))
+
+
+def read_rows(content):
+    """
+    A labels row, then the Titan and S&P 500 rows, each starting with a header cell.
+    """
+    reader = csv.reader(io.StringIO(content, newline=''))
+    return next(reader)[1:], next(reader)[1:], next(reader)[1:]
+
+
+def downsample(x, series, threshold):
+    """
+    Largest-Triangle-Three-Buckets over several series sharing the x axis: returns the indices of
+    `threshold` points that keep the visual shape, always including the first and the last one.
+    A point's triangle area is summed over all series, so one set of labels fits all of them.
+    """
+    size = len(x)
+    if threshold >= size or threshold < 3:
+        return np.arange(size)
+
+    x = x.astype(np.float64)
+    y = np.vstack(series)
+    edges = np.linspace(1, size - 1, threshold - 1).astype(np.intp)
+    selected = np.empty(threshold, dtype=np.intp)
+    selected[0], selected[-1] = 0, size - 1
+
+    previous = 0
+    for bucket in range(threshold - 2):
+        start, stop = edges[bucket], edges[bucket + 1]
+        next_stop = edges[bucket + 2] if bucket + 2 < len(edges) else size
+        next_x = x[stop:next_stop].mean()
+        next_y = y[:, stop:next_stop].mean(axis=1)[:, np.newaxis]
+        previous_y = y[:, previous:previous + 1]
+        areas = np.abs((x[previous] - next_x) * (y[:, start:stop] - previous_y)
+                       - (x[previous] - x[start:stop]) * (next_y - previous_y)).sum(axis=0)
+        previous = selected[bucket + 1] = start + int(areas.argmax())
+    return selected
+
+
+def performance(labels, prices):
+    """
+    The STAT_LABELS metrics of every row of `prices`, sampled at the timestamps `labels`, as one array
+    per metric. Returns, volatility and drawdown are fractions, annualized ones over the calendar time the
+    range spans, and the Sharpe ratio is in excess of STATS_RISK_FREE_RATE. NaN where the range is too short.
+    """
+    count = prices.shape[1]
+    if count < 2 or labels[-1] == labels[0]:
+        return [np.full(len(prices), np.nan)] * len(STAT_LABELS)
+    years = (labels[-1] - labels[0]) / YEAR
+    periods_per_year = (count - 1) / years
+    total = prices[:, -1] / prices[:, 0] - 1
+    returns = prices[:, 1:] / prices[:, :-1] - 1
+    with np.errstate(divide='ignore', invalid='ignore'):
+        annualized = (1 + total) ** (1 / years) - 1
+        volatility = returns.std(axis=1, ddof=1) * np.sqrt(periods_per_year) if count > 2 \
+            else np.full(len(prices), np.nan)
+        risk_free = (1 + getattr(settings, 'STATS_RISK_FREE_RATE', 0)) ** (1 / periods_per_year) - 1
+        sharpe = (returns.mean(axis=1) - risk_free) * periods_per_year / volatility
+    drawdown = (prices / np.maximum.accumulate(prices, axis=1)).min(axis=1) - 1
+
+    months = labels.astype('datetime64[s]').astype('datetime64[M]')
+    month_ends = np.append(np.flatnonzero(months[1:] != months[:-1]), count - 1)
+    # the first month is measured from the first sample of the range
+    closes = prices[:, np.union1d([0], month_ends)]
+    monthly = closes[:, 1:] / closes[:, :-1] - 1
+    return [total, annualized, volatility, drawdown, sharpe, monthly.max(axis=1), monthly.min(axis=1)]
+
+
+def stat_value(label, value):
+    if not np.isfinite(value):
+        return None
+    return round(float(value), 2) if label == 'Sharpe ratio' else round(float(value) * 100, 2)
+
+
+class Chart(object):
+    def __init__(self, labels, titan, sp500):
+        self.labels = labels
+        self.titan = titan
+        self.sp500 = sp500
+
+    @classmethod
+    def from_csv(cls, content):
+        labels, titan, sp500 = read_rows(content)
+        labels = np.fromiter(map(parse_date, labels), dtype=np.int64, count=len(labels))
+        order = np.argsort(labels, kind='mergesort')
+        return cls(labels[order], np.array(titan, dtype=np.float64)[order], np.array(sp500, dtype=np.float64)[order])
+
+    def bounds(self, start=None, end=None):
+        """
+        Index range of the points with start <= label <= end.
+        """
+        low = 0 if start is None else int(np.searchsorted(self.labels, start, side='left'))
+        high = len(self.labels) if end is None else int(np.searchsorted(self.labels, end, side='right'))
+        return low, max(low, high)
+
+    def period_bounds(self, period):
+        if not len(self.labels):
+            return 0, 0
+        return self.bounds(period_start(period, int(self.labels[-1])))
+
+    def select(self, low, high, points=None):
+        labels, titan, sp500 = self.labels[low:high], self.titan[low:high], self.sp500[low:high]
+        if points:
+            selected = downsample(labels, (titan, sp500), points)
+            labels, titan, sp500 = labels[selected], titan[selected], sp500[selected]
+        return labels, titan, sp500
+
+    def as_dict(self, low, high, points=None):
+        labels, titan, sp500 = self.select(low, high, points)
+        return {'labels': labels.tolist(), 'titan': titan.tolist(), 'sp500': sp500.tolist()}
+
+    def as_compact(self, low, high, points=None):
+        """
+        Values as float32, which is plenty to draw them. Labels are sent as the first one followed by
+        the differences between consecutive ones, which gzip shrinks to almost nothing.
+        """
+        labels, titan, sp500 = self.select(low, high, points)
+        columns = (np.concatenate((labels[:1], np.diff(labels))), titan, sp500)
+        data = {name: base64.b64encode(column.astype(dtype).tobytes()).decode('ascii')
+                for (name, dtype), column in zip(COMPACT_DTYPES, columns)}
+        data['length'] = len(labels)
+        return data
+
+    def stats(self, low, high):
+        """
+        Performance of both series over the points low..high, in percent except for the Sharpe ratio.
+        """
+        metrics = performance(self.labels[low:high], np.vstack((self.titan[low:high], self.sp500[low:high])))
+        return [{'label': label, 'titan': stat_value(label, titan), 'sp500': stat_value(label, sp500)}
+                for label, (titan, sp500) in zip(STAT_LABELS, metrics)]
+
+
+def dump_json(data):
+    return json.dumps(data, separators=(',', ':')).encode()
+
+
+class Payload(object):
+    """
+    One JSON response body, plain and gzipped. The ETag is known upfront, so conditional requests
+    are answered without building the body. Bodies are built on first use by a single worker of the
+    node and shared with the others through the shared cache, keyed by the content-derived ETag.
+    """
+    def __init__(self, etag, last_modified, build):
+        self.etag = etag
+        self.last_modified = last_modified
+        self.build = build
+        self._bodies = None
+
+    def encode(self):
+        body = dump_json(self.build())
+        return body, gzip.compress(body, 9)
+
+    @property
+    def bodies(self):
+        if self._bodies is None:
+            self._bodies = shared_cache.get_or_compute(
+                'charts:payload:' + self.etag, self.encode, getattr(settings, 'CHART_CACHE_TTL', 3600))
+        return self._bodies
+
+    @property
+    def body(self):
+        return self.bodies[0]
+
+    @property
+    def gzipped(self):
+        return self.bodies[1]
+
+
+class LoadedFile(object):
+    def __init__(self, signature, digest, data):
+        self.signature = signature
+        self.digest = digest
+        self.data = data
+        self.checked_at = time.monotonic()
+        self.payloads = OrderedDict()
+        self.lock = threading.Lock()
+
+    @property
+    def last_modified(self):
+        return self.signature[0] // 10 ** 9
+
+    def payload(self, key, build, *args):
+        """
+        Payload of build(data, *args), kept for the CHART_PAYLOAD_CACHE_SIZE most recently used
+        keys of this version of the file.
+        """
+        with self.lock:
+            payload = self.payloads.get(key)
+            if payload is not None:
+                self.payloads.move_to_end(key)
+                return payload
+            etag = '"{}-{}"'.format(self.digest, '-'.join(str(part) for part in key))
+            payload = self.payloads[key] = Payload(etag, self.last_modified, lambda: build(self.data, *args))
+            while len(self.payloads) > getattr(settings, 'CHART_PAYLOAD_CACHE_SIZE', 256):
+                self.payloads.popitem(last=False)
+            return payload
+
+
+class FileStore(object):
+    def __init__(self, read):
+        self.read = read
+        self.files = {}
+        self.lock = threading.Lock()
+
+    def load(self, path):
+        loaded = self.files.get(path)
+        if loaded is not None and time.monotonic() - loaded.checked_at < getattr(settings, 'CHART_RELOAD_INTERVAL', 1):
+            return loaded
+
+        stat = os.stat(path)
+        signature = (stat.st_mtime_ns, stat.st_size)
+        if loaded is None or loaded.signature != signature:
+            with self.lock:
+                loaded = self.files.get(path)
+                if loaded is None or loaded.signature != signature:
+                    digest, data = self.read(path)
+                    loaded = self.files[path] = LoadedFile(signature, digest, data)
+        loaded.checked_at = time.monotonic()
+        return loaded
+
+
+def read_csv(path):
+    """
+    (digest, Chart) of the CSV file at `path`.
+    """
+    with open(path, 'rb') as csv_file:
+        content = csv_file.read()
+    return hashlib.sha1(content).hexdigest()[:16], Chart.from_csv(content.decode())
+
+
+def write_store(chart, digest, path):
+    """
+    Writes `chart` as a chart store, replacing `path` atomically: workers that mapped the previous
+    file keep reading it until they notice the new one.
+    """
+    temporary = '{}.{}.tmp'.format(path, os.getpid())
+    with open(temporary, 'wb') as output:
+        output.write(STORE_HEADER.pack(STORE_MAGIC, STORE_VERSION, len(chart.labels), digest.encode('ascii')))
+        for column, dtype in zip((chart.labels, chart.titan, chart.sp500), STORE_DTYPES):
+            output.write(column.astype(dtype).tobytes())
+    os.replace(temporary, path)
+
+
+def read_store(path):
+    """
+    (digest, Chart) of the chart store at `path`, its arrays being read-only views of the mapped file.
+    """
+    with open(path, 'rb') as store:
+        mapped = mmap.mmap(store.fileno(), 0, access=mmap.ACCESS_READ)
+    if len(mapped) < STORE_HEADER.size:
+        raise ValueError('{} is not a chart store'.format(path))
+    magic, version, count, digest = STORE_HEADER.unpack_from(mapped)
+    if magic != STORE_MAGIC or version != STORE_VERSION or len(mapped) != STORE_HEADER.size + 24 * count:
+        raise ValueError('{} is not a chart store'.format(path))
+    columns = [np.frombuffer(mapped, dtype=dtype, count=count, offset=STORE_HEADER.size + 8 * count * index)
+               for index, dtype in enumerate(STORE_DTYPES)]
+    return digest.decode('ascii'), Chart(*columns)
+
+
+charts = FileStore(read_csv)
+stores = FileStore(read_store)
+
+
+def load_chart():
+    store = getattr(settings, 'PATH_TO_CHART_STORE', None)
+    if store:
+        return stores.load(store)
+    return charts.load(settings.PATH_TO_CSV_CHART)
+
+
+def range_bounds(chart, period, start, end):
+    """
+    Index range of `period`, or of start <= label <= end when either of them is given.
+    """
+    if start is None and end is None:
+        return chart.period_bounds(period)
+    return chart.bounds(start, end)
+
+
+def chart_payload(period='ALL', start=None, end=None, points=None, compact=False):
+    """
+    Chart for `period` or the `start`..`end` range, optionally downsampled to `points` points, in
+    the compact format if asked to.
+    """
+    loaded = load_chart()
+    low, high = range_bounds(loaded.data, period, start, end)
+    if points is not None and points >= high - low:
+        points = None
+    if compact:
+        return loaded.payload((low, high, points, 'compact{}'.format(COMPACT_VERSION)), Chart.as_compact,
+                              low, high, points)
+    return loaded.payload((low, high, points), Chart.as_dict, low, high, points)
+
+
+def stats_payload(period='ALL', start=None, end=None):
+    """
+    Stats of `period` or the `start`..`end` range, computed once per version of the chart file.
+    """
+    loaded = load_chart()
+    low, high = range_bounds(loaded.data, period, start, end)
+    return loaded.payload(('stats', low, high), Chart.stats, low, high)
+
+
+def warm_up():
+    """
+    Parses the chart file and serializes and compresses the chart and stats of every period, so the
+    first requests of a worker don't pay for it.
+    """
+    try:
+        for period in PERIODS:
+            chart_payload(period).gzipped
+            stats_payload(period).gzipped
+    except (OSError, ValueError, StopIteration):
+        logger.warning('Could not load chart', exc_info=True)
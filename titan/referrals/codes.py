@@ -0,0 +1,63 @@
+"""
+Referral codes are a keyed permutation of the wait-list position, so issuing one needs no
+lookups: distinct positions always map to distinct codes.
+"""
+import hashlib
+import string
+
+from django.conf import settings
+
+ALPHABET = string.ascii_uppercase + string.digits
+CODE_LENGTH = 8
+DOMAIN = len(ALPHABET) ** CODE_LENGTH
+
+# Smallest even bit width covering DOMAIN, so the Feistel halves are equal.
+HALF_BITS = 21
+HALF_MASK = (1 << HALF_BITS) - 1
+ROUNDS = 4
+
+# Positions are far below this, so (position, attempt) pairs never overlap.
+ATTEMPT_STRIDE = 1 << 34
+# Legacy codes are too few for this many attempts in a row to clash by chance.
+MAX_ATTEMPTS = 8
+
+
+def get_key():
+    return getattr(settings, 'REFERRAL_CODE_KEY', settings.SECRET_KEY).encode()
+
+
+def _round(key, round_number, half):
+    digest = hashlib.blake2b(half.to_bytes(4, 'big'), digest_size=4, key=key[:64],
+                             person=b'titan-ref' + bytes([round_number])).digest()
+    return int.from_bytes(digest, 'big') & HALF_MASK
+
+
+def permute(number, key):
+    """
+    Bijection on range(DOMAIN). The Feistel network permutes 42-bit values, and cycle walking
+    keeps re-applying it until the result falls back into the domain.
+    """
+    if not 0 <= number < DOMAIN:
+        raise ValueError('{} is outside of the referral code domain'.format(number))
+    while True:
+        left, right = number >> HALF_BITS, number & HALF_MASK
+        for round_number in range(ROUNDS):
+            left, right = right, left ^ _round(key, round_number, right)
+        number = (left << HALF_BITS) | right
+        if number < DOMAIN:
+            return number
+
+
+def encode(number):
+    chars = []
+    for _ in range(CODE_LENGTH):
+        number, index = divmod(number, len(ALPHABET))
+        chars.append(ALPHABET[index])
+    return ''.join(reversed(chars))
+
+
+def referral_code_for(position, attempt=0, key=None):
+    """
+    `attempt` only matters when the first code collides with a legacy, randomly drawn one.
+    """
+    return encode(permute(position + attempt * ATTEMPT_STRIDE, key or get_key()))
@@ -0,0 +1,69 @@
+from datetime import timedelta
+from functools import lru_cache
+
+from django.conf import settings
+from django.db import transaction
+from django.template import loader
+from django.utils import timezone
+
+from referrals import metrics
+from referrals.models import OutboundEmail, ReferrerDigest
+
+
+@lru_cache(maxsize=None)
+def get_template(template_name):
+    """
+    Templates are compiled once per process, whatever the template loaders configuration.
+    """
+    return loader.get_template(template_name)
+
+
+def render_to_string(template_name, context):
+    with metrics.timed_template():
+        return get_template(template_name).render(context)
+
+
+def welcome_email(base_url, referral_code, email):
+    context = {'url': '{}#!/{}'.format(base_url, referral_code),
+               'logo_url': '{}/images/Titan_logo.png'.format(base_url)}
+    return OutboundEmail.compose(subject='Welcome to Titan!',
+                                 message=render_to_string('email-titan-template.txt', context),
+                                 html_message=render_to_string('email-titan-template.html', context),
+                                 recipient=email)
+
+
+def notify_user(base_url, referral_code, email):
+    welcome_email(base_url, referral_code, email).save()
+
+
+def notify_referrer(base_url, email, referrals=1):
+    context = {'status_url': '{}#!/check-status/{}'.format(base_url, email),
+               'logo_url': '{}/images/Titan_logo.png'.format(base_url),
+               'referrals': referrals}
+    OutboundEmail.enqueue(subject='Thank you!',
+                          message=render_to_string('email-titan-template-after-signup.txt', context),
+                          html_message=render_to_string('email-titan-template-after-signup.html', context),
+                          recipient=email)
+
+
+def notify_referrer_of_signup(base_url, referrer, referrals=1):
+    """
+    With REFERRER_DIGEST_WINDOW set, referrals are only counted here and a single email per referrer
+    is sent by flush_referrer_digests once the window has passed.
+    """
+    if getattr(settings, 'REFERRER_DIGEST_WINDOW', 0):
+        ReferrerDigest.add(referrer.pk, base_url, referrals)
+    else:
+        notify_referrer(base_url, referrer.email, referrals)
+
+
+def flush_referrer_digests(batch_size=500):
+    window = timedelta(seconds=getattr(settings, 'REFERRER_DIGEST_WINDOW', 0))
+    with transaction.atomic():
+        digests = list(ReferrerDigest.objects.select_for_update(skip_locked=True)
+                       .filter(first_referral_at__lte=timezone.now() - window)
+                       .select_related('referrer').order_by('first_referral_at')[:batch_size])
+        for digest in digests:
+            notify_referrer(digest.base_url, digest.referrer.email, digest.referrals)
+        ReferrerDigest.objects.filter(pk__in=[digest.pk for digest in digests]).delete()
+    return len(digests)
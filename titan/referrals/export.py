@@ -0,0 +1,58 @@
+"""
+The whole wait list, one line per user in sign-up order, for CRM syncs. Referral counts, positions and
+tree stats are stored on each row and the referrer's code comes from a join, so this is a single
+query. It is read through a server-side cursor on PostgreSQL (QuerySet.iterator()), so memory does
+not depend on the number of users.
+"""
+import csv
+import json
+
+from referrals import ranking
+from referrals.models import RegisteredUser
+
+FORMATS = ('csv', 'ndjson')
+CONTENT_TYPES = {'csv': 'text/csv', 'ndjson': 'application/x-ndjson'}
+
+COLUMNS = (
+    ('email', 'email'),
+    ('referral_code', 'referral_code'),
+    ('referred_by', 'referred_by__referral_code'),
+    ('referral_count', 'referral_count'),
+    ('wait_list_position', 'wait_list_position'),
+    ('depth', 'depth'),
+    ('descendant_count', 'descendant_count'),
+    ('registration_datetime', 'registration_datetime'),
+)
+
+
+class Echo(object):
+    """
+    File-like object handing back what csv.writer writes to it.
+    """
+    def write(self, value):
+        return value
+
+
+def rows():
+    names = [name for name, _ in COLUMNS]
+    lookups = [lookup for _, lookup in COLUMNS]
+    yield names + ['wait_list_rank']
+    users = RegisteredUser.objects.order_by('wait_list_position').values_list(*lookups)
+    for row in users.iterator():
+        yield row + (ranking.wait_list_rank(row[4], row[3]),)
+
+
+def lines(output_format):
+    """
+    The export as an iterator of text lines in `output_format` ('csv' or 'ndjson').
+    """
+    users = rows()
+    if output_format == 'csv':
+        writer = csv.writer(Echo())
+        for row in users:
+            yield writer.writerow(row)
+        return
+
+    names = next(users)
+    for row in users:
+        yield json.dumps(dict(zip(names, row)), default=str) + '\n'
@@ -0,0 +1,110 @@
+"""
+Top referrers, ordered by referral_count (descending) and then sign-up order, read through the
+(-referral_count, wait_list_position) index so a page costs the same at any table size.
+
+The first LEADERBOARD_SIZE entries are snapshotted in the shared cache every LEADERBOARD_TTL seconds
+and pages are cut from the snapshot the cursor points to, so paging through stays consistent while
+counts keep changing. Cursors are keyset based (the last entry's count and position), so once their
+snapshot has expired the next page is read from the table right after that entry instead.
+
+Entries show a masked email, never the referral code: the code is all it takes to read a user's
+payload and to log in as them.
+"""
+import bisect
+import uuid
+
+from django.conf import settings
+from django.db.models import Q
+
+from referrals import cache as shared_cache
+from referrals.models import RegisteredUser
+
+# snapshots of older versions held referral codes
+CURRENT_KEY = 'referrals:leaderboard:v2'
+SNAPSHOT_KEY = 'referrals:leaderboard:v2:{}'
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def mask_email(email):
+    """
+    'jane.doe@example.com' as 'j***@e***.com'.
+    """
+    local, _, domain = email.partition('@')
+    host, dot, tld = domain.rpartition('.')
+    if not dot:
+        host, tld = tld, ''
+    return '{}***@{}***{}{}'.format(local[:1], host[:1], dot, tld)
+
+
+def referrers():
+    return RegisteredUser.objects.filter(referral_count__gt=0) \
+        .order_by('-referral_count', 'wait_list_position') \
+        .values_list('referral_count', 'wait_list_position', 'email')
+
+
+def take_snapshot():
+    snapshot_id = uuid.uuid4().hex[:12]
+    rows = [(-count, position, mask_email(email))
+            for count, position, email in referrers()[:getattr(settings, 'LEADERBOARD_SIZE', 1000)]]
+    ttl = getattr(settings, 'LEADERBOARD_TTL', 60) + getattr(settings, 'LEADERBOARD_CURSOR_TTL', 600)
+    shared_cache.get_cache().set(SNAPSHOT_KEY.format(snapshot_id), rows, ttl)
+    return snapshot_id, rows
+
+
+def current_snapshot():
+    return shared_cache.get_or_compute(CURRENT_KEY, take_snapshot, getattr(settings, 'LEADERBOARD_TTL', 60))
+
+
+def encode_cursor(snapshot_id, count, position, rank):
+    return '{}.{}.{}.{}'.format(snapshot_id, count, position, rank)
+
+
+def decode_cursor(cursor):
+    try:
+        snapshot_id, count, position, rank = cursor.split('.')
+        return snapshot_id, int(count), int(position), int(rank)
+    except ValueError:
+        raise InvalidCursor(cursor)
+
+
+def page(limit, cursor=None):
+    """
+    Returns `limit` entries as {name, referral_count, rank} dicts, and the cursor of the
+    next page or None.
+    """
+    if cursor is None:
+        snapshot_id, rows = current_snapshot()
+        start, rank = 0, 0
+    else:
+        snapshot_id, count, position, rank = decode_cursor(cursor)
+        rows = shared_cache.get_cache().get(SNAPSHOT_KEY.format(snapshot_id)) if snapshot_id else None
+        if rows is None:
+            return page_from_table(limit, count, position, rank)
+        # (-count, position + 1) sorts right after every row of the cursor's entry
+        start = bisect.bisect_left(rows, (-count, position + 1))
+
+    selected = rows[start:start + limit]
+    entries = [{'name': name, 'referral_count': -count, 'rank': rank + offset}
+               for offset, (count, position, name) in enumerate(selected, 1)]
+    if start + limit < len(rows):
+        count, position, _ = selected[-1]
+        return entries, encode_cursor(snapshot_id, -count, position, rank + len(selected))
+    if len(rows) == getattr(settings, 'LEADERBOARD_SIZE', 1000) and selected:
+        # the table goes on past the snapshot
+        count, position, _ = selected[-1]
+        return entries, encode_cursor('', -count, position, rank + len(selected))
+    return entries, None
+
+
+def page_from_table(limit, count, position, rank):
+    after = Q(referral_count__lt=count) | Q(referral_count=count, wait_list_position__gt=position)
+    selected = list(referrers().filter(after)[:limit + 1])
+    entries = [{'name': mask_email(email), 'referral_count': count, 'rank': rank + offset}
+               for offset, (count, position, email) in enumerate(selected[:limit], 1)]
+    if len(selected) > limit:
+        count, position, _ = selected[limit - 1]
+        return entries, encode_cursor('', count, position, rank + limit)
+    return entries, None
@@ -0,0 +1,22 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from referrals import charts
+
+
+class Command(BaseCommand):
+    help = 'Converts the chart CSV file into the binary chart store that workers memory-map. Run it after ' \
+           'every change to the CSV file; workers pick up the new store within CHART_RELOAD_INTERVAL seconds.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--source', help='Chart CSV file, PATH_TO_CSV_CHART by default.')
+        parser.add_argument('--output', help='Chart store to write, PATH_TO_CHART_STORE by default.')
+
+    def handle(self, *args, **options):
+        source = options['source'] or settings.PATH_TO_CSV_CHART
+        output = options['output'] or getattr(settings, 'PATH_TO_CHART_STORE', None)
+        if not output:
+            raise CommandError('Set PATH_TO_CHART_STORE or pass --output')
+        digest, chart = charts.read_csv(source)
+        charts.write_store(chart, digest, output)
+        self.stdout.write('Wrote {} points to {}'.format(len(chart.labels), output))
@@ -0,0 +1,27 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from referrals.tree import flush_descendant_counts
+
+
+class Command(BaseCommand):
+    help = 'Counts newly joined users in the descendant_count of their ancestors, applying the queue left ' \
+           'by joins in batches.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Queued users counted per transaction.')
+        parser.add_argument('--interval', type=float, default=5, help='Seconds to sleep when the queue is empty.')
+        parser.add_argument('--once', action='store_true', help='Drain the queue and exit.')
+
+    def handle(self, *args, **options):
+        try:
+            while True:
+                if flush_descendant_counts(options['batch_size']):
+                    continue
+                elif options['once']:
+                    return
+                else:
+                    time.sleep(options['interval'])
+        except KeyboardInterrupt:
+            pass
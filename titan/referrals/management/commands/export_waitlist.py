@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from referrals import export
+
+
+class Command(BaseCommand):
+    help = 'Writes every registered user, in sign-up order, as CSV or newline-delimited JSON.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=export.FORMATS, default='csv')
+        parser.add_argument('--output', help='File to write to instead of standard output.')
+
+    def handle(self, *args, **options):
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8', newline='') as output:
+                output.writelines(export.lines(options['format']))
+        else:
+            for line in export.lines(options['format']):
+                self.stdout.write(line, ending='')
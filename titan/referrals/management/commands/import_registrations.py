@@ -0,0 +1,183 @@
+import csv
+import io
+import itertools
+import sys
+from collections import Counter
+
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+from django.core.validators import validate_email
+from django.db import IntegrityError, connections, router, transaction
+from django.db.models import F
+
+from referrals.codes import referral_code_for
+from referrals.emails import notify_referrer_of_signup, welcome_email
+from referrals.models import CounterShard, OutboundEmail, RegisteredUser, Sequence, rank_stamp
+from referrals.tree import add_descendants, grouped_by_count
+
+
+def copy_value(value):
+    if value is None:
+        return '\\N'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def registered_emails(emails):
+    return set(RegisteredUser.objects.filter(email__in=emails).values_list('email', flat=True))
+
+
+def insert_users(users):
+    """
+    bulk_create, except on PostgreSQL where COPY skips building a huge INSERT statement.
+    """
+    connection = connections[router.db_for_write(RegisteredUser)]
+    if connection.vendor != 'postgresql':
+        RegisteredUser.objects.bulk_create(users)
+        return
+    fields = [field for field in RegisteredUser._meta.concrete_fields if not field.primary_key]
+    lines = ('\t'.join(copy_value(field.get_db_prep_save(field.pre_save(user, True), connection)) for field in fields)
+             for user in users)
+    # Django turns psycopg2 errors into its own for execute() and fetches, not for copy_expert()
+    with connection.cursor() as cursor, connection.wrap_database_errors:
+        cursor.copy_expert('COPY {} ({}) FROM STDIN'.format(
+            connection.ops.quote_name(RegisteredUser._meta.db_table),
+            ', '.join(connection.ops.quote_name(field.column) for field in fields)),
+            io.StringIO(''.join(line + '\n' for line in lines)))
+
+
+class Command(BaseCommand):
+    help = 'Registers the emails of a CSV file (with a header row) in batches, in file order. Rows with an ' \
+           'invalid or already registered email or an unknown referrer code are skipped. Each batch is one ' \
+           'transaction; except on PostgreSQL, web registrations wait for their wait-list position meanwhile.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="CSV file, '-' for standard input.")
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--email-column', default='email')
+        parser.add_argument('--referrer-column', default='referrer_code',
+                            help='Column with the referral code of whoever referred the user, if the file has one.')
+        parser.add_argument('--notify', metavar='BASE_URL',
+                            help='Queue welcome and referrer emails with links to BASE_URL (none by default).')
+
+    def handle(self, *args, **options):
+        if options['path'] == '-':
+            source = io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8-sig', newline='')
+        else:
+            source = open(options['path'], encoding='utf-8-sig', newline='')
+        self.verbosity = options['verbosity']
+        self.totals = Counter()
+        with source:
+            reader = csv.DictReader(source)
+            if options['email_column'] not in (reader.fieldnames or ()):
+                raise CommandError('No {} column'.format(options['email_column']))
+            referrer_column = options['referrer_column'] if options['referrer_column'] in reader.fieldnames else None
+
+            rows = enumerate(reader, 2)
+            while True:
+                batch = list(itertools.islice(rows, options['batch_size']))
+                if not batch:
+                    break
+                with transaction.atomic():
+                    self.import_batch(batch, options['email_column'], referrer_column, options['notify'])
+                if self.verbosity > 1:
+                    self.stdout.write('{} rows read'.format(batch[-1][0] - 1))
+
+        self.stdout.write('Imported {} users, skipped {} duplicate, {} invalid and {} with an unknown referrer'.format(
+            self.totals['imported'], self.totals['duplicate'], self.totals['invalid'], self.totals['unknown referrer']))
+
+    def skip(self, line, reason, email):
+        self.totals[reason] += 1
+        if self.verbosity > 1:
+            self.stderr.write('line {}: {} {}'.format(line, reason, email))
+
+    def import_batch(self, batch, email_column, referrer_column, base_url):
+        rows = {}
+        for line, row in batch:
+            email = (row[email_column] or '').strip()
+            try:
+                validate_email(email)
+            except ValidationError:
+                self.skip(line, 'invalid', email)
+                continue
+            if email in rows:
+                self.skip(line, 'duplicate', email)
+                continue
+            referrer_code = (row[referrer_column] or '').strip() if referrer_column else ''
+            rows[email] = (line, referrer_code or None)
+
+        registered = registered_emails(rows)
+        referrers = {user.referral_code: user for user in RegisteredUser.objects
+                     .filter(referral_code__in={code for _, code in rows.values() if code})
+                     .only('email', 'referral_code', 'referral_path', 'depth')}
+        new = []
+        for email, (line, code) in rows.items():
+            if email in registered:
+                self.skip(line, 'duplicate', email)
+            elif code is not None and code not in referrers:
+                self.skip(line, 'unknown referrer', email)
+            else:
+                new.append((email, referrers.get(code)))
+
+        while new:
+            try:
+                with transaction.atomic():
+                    self.insert_batch(new, base_url)
+            except IntegrityError:
+                # Web joins may have registered some of the emails since they were looked up
+                registered = registered_emails([email for email, _ in new])
+                if not registered:
+                    raise
+                for email, _ in new:
+                    if email in registered:
+                        self.skip(rows[email][0], 'duplicate', email)
+                new = [(email, referrer) for email, referrer in new if email not in registered]
+            else:
+                self.totals['imported'] += len(new)
+                return
+
+    def insert_batch(self, new, base_url):
+        positions = Sequence.reserve(Sequence.WAIT_LIST, len(new))
+        stamp = rank_stamp(router.db_for_write(RegisteredUser), positions[-1])
+        users = []
+        for (email, referrer), position, code in zip(new, positions, self.referral_codes(positions)):
+            user = RegisteredUser(email=email, wait_list_position=position, referral_code=code, rank_version=stamp)
+            if referrer is not None:
+                user.referred_by = referrer
+                user.referral_path = '{}{}/'.format(referrer.referral_path, referrer.pk)
+                user.depth = referrer.depth + 1
+            users.append(user)
+        insert_users(users)
+        CounterShard.increment(CounterShard.TOTAL_REGISTERED, len(users))
+        self.credit_referrers(users, stamp)
+
+        if base_url:
+            OutboundEmail.objects.bulk_create(welcome_email(base_url, user.referral_code, user.email) for user in users)
+            referrals = Counter(user.referred_by for user in users if user.referred_by_id is not None)
+            for referrer, count in referrals.items():
+                notify_referrer_of_signup(base_url, referrer, count)
+
+    @staticmethod
+    def referral_codes(positions):
+        """
+        Codes of `positions`, drawing the next attempt for the few that clash with legacy codes.
+        """
+        codes = {position: referral_code_for(position) for position in positions}
+        attempts = Counter()
+        pending = list(positions)
+        while pending:
+            taken = set(RegisteredUser.objects.filter(referral_code__in=[codes[position] for position in pending])
+                        .values_list('referral_code', flat=True))
+            pending = [position for position in pending if codes[position] in taken]
+            for position in pending:
+                attempts[position] += 1
+                codes[position] = referral_code_for(position, attempts[position])
+        return [codes[position] for position in positions]
+
+    @staticmethod
+    def credit_referrers(users, stamp):
+        referrals = Counter(user.referred_by_id for user in users if user.referred_by_id is not None)
+        descendants = Counter(ancestor for user in users for ancestor in user.ancestor_ids())
+        for count, ids in grouped_by_count(referrals):
+            RegisteredUser.objects.filter(pk__in=ids).update(
+                referral_count=F('referral_count') + count, rank_version=stamp)
+        add_descendants(descendants)
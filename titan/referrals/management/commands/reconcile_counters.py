@@ -0,0 +1,45 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, F
+
+from referrals import cache as shared_cache, ranking
+from referrals.models import CounterShard, RegisteredUser
+
+
+class Command(BaseCommand):
+    help = 'Recomputes total_registered and per-user referral_count from the registrations table and fixes drift.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Only report drift, do not write anything.')
+
+    def handle(self, *args, **options):
+        dry_run = options['dry_run']
+
+        with transaction.atomic():
+            # Joins bump a shard in the transaction inserting the user. With the shards locked, every
+            # join either committed before the count or waits to add its user on top of the new value;
+            # a missing shard would be inserted without waiting.
+            for shard in range(getattr(settings, 'COUNTER_SHARDS', 8)):
+                CounterShard.objects.get_or_create(name=CounterShard.TOTAL_REGISTERED, shard=shard)
+            list(CounterShard.objects.select_for_update().filter(name=CounterShard.TOTAL_REGISTERED))
+            total = RegisteredUser.objects.count()
+            counted = CounterShard.get_value(CounterShard.TOTAL_REGISTERED)
+            if total != counted:
+                self.stdout.write('total_registered: {} -> {}'.format(counted, total))
+                if not dry_run:
+                    CounterShard.set_value(CounterShard.TOTAL_REGISTERED, total)
+
+            drifted = RegisteredUser.objects.annotate(actual=Count('registered_users')) \
+                .exclude(referral_count=F('actual')).only('email', 'referral_code', 'referral_count')
+            fixed = 0
+            for user in drifted.iterator():
+                self.stdout.write('referral_count of {}: {} -> {}'.format(user.email, user.referral_count, user.actual))
+                if not dry_run:
+                    RegisteredUser.objects.filter(id=user.id).update(referral_count=user.actual)
+                    shared_cache.invalidate_user(user)
+                fixed += 1
+            if fixed and not dry_run:
+                ranking.reset()
+
+        self.stdout.write('{} referral counters {}'.format(fixed, 'drifted' if dry_run else 'fixed'))
@@ -0,0 +1,35 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from referrals import metrics
+from referrals.emails import flush_referrer_digests
+from referrals.outbox import send_batch
+
+
+class Command(BaseCommand):
+    help = 'Sends queued emails from the outbox in batches, retrying failed ones with backoff. ' \
+           'Also turns referrer digests whose window has passed into emails.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=None, help='Emails sent per connection.')
+        parser.add_argument('--interval', type=float, default=5, help='Seconds to sleep when the outbox is empty.')
+        parser.add_argument('--once', action='store_true', help='Drain what is due and exit.')
+        parser.add_argument('--metrics-file', help='Prometheus text file for the node exporter, rewritten after '
+                                                   'every batch.')
+
+    def handle(self, *args, **options):
+        try:
+            while True:
+                flush_referrer_digests()
+                handled = send_batch(options['batch_size'])
+                if options['metrics_file']:
+                    metrics.write_textfile(options['metrics_file'], metrics.EMAIL_METRICS)
+                if handled:
+                    self.stdout.write('Handled {} emails'.format(handled))
+                elif options['once']:
+                    return
+                else:
+                    time.sleep(options['interval'])
+        except KeyboardInterrupt:
+            pass
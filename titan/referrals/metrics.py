@@ -0,0 +1,249 @@
+"""
+Request latency, SQL, template and email timings per `referrals.urls` route, kept in this process and
+exported in the Prometheus text format at /api/metrics/. Every gunicorn worker has its own numbers,
+labelled with its pid, so scrape each worker or sum over `worker`.
+
+Latency, request counts and template rendering are recorded for every request. SQL statements are
+timed by wrapping the database cursors of a METRICS_SQL_SAMPLE_RATE fraction of requests only (Django
+1.11 has no execute wrapper hook), so SQL counts and durations describe the sampled requests.
+Emails are sent by send_outbox, which writes its metrics to a file for the node exporter instead.
+
+Only staff users and clients listed in METRICS_ALLOWED_IPS may read the metrics.
+"""
+import os
+import random
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connections
+from django.db.backends.utils import CursorWrapper
+from django.utils.deprecation import MiddlewareMixin
+from rest_framework.permissions import BasePermission
+
+from referrals.cache import user_cache_stats
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55)
+EMAIL_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+state = threading.local()
+
+
+class Counter(object):
+    kind = 'counter'
+
+    def __init__(self, name, help_text, labels=()):
+        self.name, self.help_text, self.labels = name, help_text, labels
+        self.values = defaultdict(float)
+        self.lock = threading.Lock()
+
+    def inc(self, label_values=(), amount=1):
+        with self.lock:
+            self.values[label_values] += amount
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, label_values, value) for label_values, value in sorted(self.values.items())]
+
+    def label_names(self, sample_name):
+        return self.labels
+
+
+class Histogram(Counter):
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = buckets
+        self.values = {}
+
+    def observe(self, label_values, value):
+        with self.lock:
+            series = self.values.get(label_values)
+            if series is None:
+                # a count per bucket, then the +Inf count and the sum
+                series = self.values[label_values] = [0] * (len(self.buckets) + 2)
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[index] += 1
+                    break
+            else:
+                series[-2] += 1
+            series[-1] += value
+
+    def samples(self):
+        with self.lock:
+            series = sorted((label_values, list(values)) for label_values, values in self.values.items())
+        samples = []
+        for label_values, values in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), values):
+                cumulative += count
+                samples.append((self.name + '_bucket', label_values + (format_value(bound),), cumulative))
+            samples.append((self.name + '_count', label_values, cumulative))
+            samples.append((self.name + '_sum', label_values, values[-1]))
+        return samples
+
+    def label_names(self, sample_name):
+        return self.labels + ('le',) if sample_name.endswith('_bucket') else self.labels
+
+
+request_duration = Histogram('titan_http_request_duration_seconds', 'Time to build the response.',
+                             ('route', 'method', 'status'))
+sql_statements = Histogram('titan_sql_statements_per_request', 'SQL statements of sampled requests.',
+                           ('route',), STATEMENT_BUCKETS)
+sql_duration = Counter('titan_sql_duration_seconds_total', 'Time spent in SQL by sampled requests.', ('route',))
+template_duration = Counter('titan_template_render_seconds_total', 'Time spent rendering templates.', ('route',))
+template_renders = Counter('titan_template_renders_total', 'Templates rendered.', ('route',))
+email_send_duration = Histogram('titan_email_send_seconds', 'Time to hand one email to the email backend.',
+                                (), EMAIL_BUCKETS)
+emails_sent = Counter('titan_emails_sent_total', 'Emails handed to the email backend.', ('result',))
+
+REQUEST_METRICS = (request_duration, sql_statements, sql_duration, template_duration, template_renders)
+EMAIL_METRICS = (email_send_duration, emails_sent)
+
+
+def enabled():
+    return getattr(settings, 'METRICS_ENABLED', True)
+
+
+class CanReadMetrics(BasePermission):
+    """
+    Staff users, or requests whose REMOTE_ADDR is in METRICS_ALLOWED_IPS. Behind a proxy that is the
+    proxy's address, so only list addresses of clients reaching gunicorn directly.
+    """
+    def has_permission(self, request, view):
+        if request.user and request.user.is_staff:
+            return True
+        return request.META.get('REMOTE_ADDR') in getattr(settings, 'METRICS_ALLOWED_IPS', ())
+
+
+def format_value(value):
+    if isinstance(value, str):
+        return value
+    if value == int(value):
+        return str(int(value))
+    return repr(float(value))
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def render(metrics, extra_labels=()):
+    """
+    `metrics` in the Prometheus text exposition format, every sample also getting `extra_labels`.
+    """
+    lines = []
+    for metric in metrics:
+        lines.append('# HELP {} {}'.format(metric.name, metric.help_text))
+        lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+        for name, label_values, value in metric.samples():
+            labels = tuple(extra_labels) + tuple(zip(metric.label_names(name), label_values))
+            if labels:
+                name += '{' + ','.join('{}="{}"'.format(key, escape(value)) for key, value in labels) + '}'
+            lines.append('{} {}'.format(name, format_value(value)))
+    return '\n'.join(lines) + '\n'
+
+
+def render_all():
+    cache = Counter('titan_user_cache_total', 'Lookups and invalidations of the user payload cache.', ('result',))
+    for result in ('hits', 'misses', 'invalidations'):
+        cache.inc((result,), user_cache_stats[result])
+    return render(REQUEST_METRICS + EMAIL_METRICS + (cache,), (('worker', os.getpid()),))
+
+
+def write_textfile(path, metrics):
+    """
+    Writes `metrics` for the node exporter's textfile collector, replacing the file atomically.
+    """
+    temporary = '{}.{}.tmp'.format(path, os.getpid())
+    with open(temporary, 'w') as output:
+        output.write(render(metrics))
+    os.replace(temporary, path)
+
+
+@contextmanager
+def timed_template():
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if getattr(state, 'active', False):
+            state.template_seconds += time.perf_counter() - start
+            state.template_renders += 1
+
+
+class TimedCursorWrapper(CursorWrapper):
+    """
+    Wraps a connection's usual cursor wrapper, adding its statements to the current request's.
+    """
+    def execute(self, sql, params=None):
+        start = time.perf_counter()
+        try:
+            return self.cursor.execute(sql, params)
+        finally:
+            self.record(start)
+
+    def executemany(self, sql, param_list):
+        start = time.perf_counter()
+        try:
+            return self.cursor.executemany(sql, param_list)
+        finally:
+            self.record(start)
+
+    @staticmethod
+    def record(start):
+        state.sql_seconds += time.perf_counter() - start
+        state.sql_statements += 1
+
+
+def time_cursors(connection):
+    make_cursor, make_debug_cursor = connection.make_cursor, connection.make_debug_cursor
+    connection.make_cursor = lambda cursor: TimedCursorWrapper(make_cursor(cursor), connection)
+    connection.make_debug_cursor = lambda cursor: TimedCursorWrapper(make_debug_cursor(cursor), connection)
+
+
+def untime_cursors(connection):
+    connection.__dict__.pop('make_cursor', None)
+    connection.__dict__.pop('make_debug_cursor', None)
+
+
+class MetricsMiddleware(MiddlewareMixin):
+    """
+    Goes first in MIDDLEWARE_CLASSES, so the latency covers every other middleware.
+    """
+    def process_request(self, request):
+        state.active = enabled()
+        if not state.active:
+            return
+        state.start = time.perf_counter()
+        state.template_seconds, state.template_renders = 0.0, 0
+        state.sql_seconds, state.sql_statements = 0.0, 0
+        state.sampled = random.random() < getattr(settings, 'METRICS_SQL_SAMPLE_RATE', 0.1)
+        if state.sampled:
+            for connection in connections.all():
+                time_cursors(connection)
+
+    def process_response(self, request, response):
+        if not getattr(state, 'active', False):
+            return response
+        state.active = False
+        elapsed = time.perf_counter() - state.start
+        match = getattr(request, 'resolver_match', None)
+        route = match.url_name if match is not None and match.url_name else 'unmatched'
+        request_duration.observe((route, request.method, str(response.status_code)), elapsed)
+        if state.template_renders:
+            template_duration.inc((route,), state.template_seconds)
+            template_renders.inc((route,), state.template_renders)
+        if state.sampled:
+            for connection in connections.all():
+                untime_cursors(connection)
+            sql_statements.observe((route,), state.sql_statements)
+            sql_duration.inc((route,), state.sql_seconds)
+        return response
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.3 on 2026-10-18 12:01
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+NUMBER_USERS_SQL = '''
+    UPDATE referrals_registereduser
+    SET wait_list_position = numbered.position
+    FROM (SELECT id, ROW_NUMBER() OVER (ORDER BY registration_datetime, id) AS position
+          FROM referrals_registereduser) AS numbered
+    WHERE referrals_registereduser.id = numbered.id
+'''
+
+
+def number_existing_users(apps, schema_editor):
+    RegisteredUser = apps.get_model('referrals', 'RegisteredUser')
+    Sequence = apps.get_model('referrals', 'Sequence')
+
+    if schema_editor.connection.vendor == 'postgresql':
+        with schema_editor.connection.cursor() as cursor:
+            cursor.execute(NUMBER_USERS_SQL)
+            position = cursor.rowcount
+        Sequence.objects.update_or_create(name='wait_list', defaults={'value': position})
+        return
+
+    position = 0
+    users = RegisteredUser.objects.order_by('registration_datetime', 'id').values_list('id', flat=True)
+    for user_id in users.iterator():
+        position += 1
+        RegisteredUser.objects.filter(id=user_id).update(wait_list_position=position)
+    Sequence.objects.update_or_create(name='wait_list', defaults={'value': position})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('referrals', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Sequence',
+            fields=[
+                ('name', models.CharField(max_length=32, primary_key=True, serialize=False)),
+                ('value', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='registereduser',
+            name='wait_list_position',
+            field=models.PositiveIntegerField(default=None, null=True, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='registereduser',
+            name='registration_datetime',
+            field=models.DateTimeField(auto_now_add=True),
+        ),
+        migrations.RunPython(number_existing_users, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.3 on 2026-10-18 12:02
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def populate_counters(apps, schema_editor):
+    RegisteredUser = apps.get_model('referrals', 'RegisteredUser')
+    CounterShard = apps.get_model('referrals', 'CounterShard')
+
+    referrals = RegisteredUser.objects.filter(referred_by__isnull=False) \
+        .values('referred_by').annotate(count=Count('id')).values_list('referred_by', 'count')
+    for referrer_id, count in referrals.iterator():
+        RegisteredUser.objects.filter(id=referrer_id).update(referral_count=count)
+    CounterShard.objects.create(name='total_registered', shard=0, value=RegisteredUser.objects.count())
+    for shard in range(1, getattr(settings, 'COUNTER_SHARDS', 8)):
+        CounterShard.objects.create(name='total_registered', shard=shard)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('referrals', '0002_wait_list_position'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CounterShard',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=32)),
+                ('shard', models.PositiveSmallIntegerField()),
+                ('value', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='registereduser',
+            name='referral_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AlterUniqueTogether(
+            name='countershard',
+            unique_together=set([('name', 'shard')]),
+        ),
+        migrations.RunPython(populate_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import itertools
+
+from django.db import migrations
+from django.db.models import Count
+
+from referrals.codes import referral_code_for
+
+
+def deduplicate_referral_codes(apps, schema_editor):
+    """
+    Random codes could be handed out twice by concurrent registrations. The earliest user keeps the
+    code, the others get a fresh one so the unique index can be created.
+    """
+    RegisteredUser = apps.get_model('referrals', 'RegisteredUser')
+
+    duplicated = RegisteredUser.objects.filter(referral_code__isnull=False).values('referral_code') \
+        .annotate(count=Count('id')).filter(count__gt=1).values_list('referral_code', flat=True)
+    for code in list(duplicated):
+        users = RegisteredUser.objects.filter(referral_code=code).order_by('wait_list_position', 'id')
+        for user in users[1:]:
+            for attempt in itertools.count():
+                new_code = referral_code_for(user.wait_list_position or user.id, attempt)
+                if not RegisteredUser.objects.filter(referral_code=new_code).exists():
+                    break
+            RegisteredUser.objects.filter(id=user.id).update(referral_code=new_code)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('referrals', '0003_counters'),
+    ]
+
+    operations = [
+        migrations.RunPython(deduplicate_referral_codes, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.3 on 2026-10-18 12:04
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('referrals', '0004_deduplicate_referral_codes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='registereduser',
+            name='referral_code',
+            field=models.CharField(default=None, max_length=8, null=True, unique=True),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.3 on 2026-10-18 12:08
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('referrals', '0006_email_outbox'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReferrerDigest',
+            fields=[
+                ('referrer', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='digest', serialize=False, to='referrals.RegisteredUser')),
+                ('referrals', models.PositiveIntegerField(default=0)),
+                ('first_referral_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+                ('base_url', models.CharField(max_length=255)),
+            ],
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.3 on 2026-10-18 12:20
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('referrals', '0008_rank_version'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='registereduser',
+            index=models.Index(fields=['-referral_count', 'wait_list_position'], name='referrals_r_referra_8c01b0_idx'),
+        ),
+    ]
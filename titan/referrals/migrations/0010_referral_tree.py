@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.3 on 2026-10-18 12:21
+from __future__ import unicode_literals
+
+from collections import defaultdict
+
+from django.db import migrations, models
+
+
+REFERRAL_TREE_SQL = '''
+    WITH RECURSIVE tree (id, path, depth) AS (
+        SELECT id, ''::text, 0::integer FROM referrals_registereduser WHERE referred_by_id IS NULL
+        UNION ALL
+        SELECT child.id, tree.path || tree.id || '/', tree.depth + 1
+        FROM referrals_registereduser AS child JOIN tree ON child.referred_by_id = tree.id
+    ), descendants AS (
+        SELECT ancestor::integer AS id, COUNT(*) AS count
+        FROM tree, unnest(string_to_array(rtrim(tree.path, '/'), '/')) AS ancestor
+        WHERE tree.path <> ''
+        GROUP BY ancestor
+    )
+    UPDATE referrals_registereduser
+    SET referral_path = tree.path, depth = tree.depth, descendant_count = COALESCE(descendants.count, 0)
+    FROM tree LEFT JOIN descendants ON descendants.id = tree.id
+    WHERE referrals_registereduser.id = tree.id AND (tree.path <> '' OR descendants.count IS NOT NULL)
+'''
+BATCH_SIZE = 500
+
+
+def populate_referral_tree(apps, schema_editor):
+    RegisteredUser = apps.get_model('referrals', 'RegisteredUser')
+
+    if schema_editor.connection.vendor == 'postgresql':
+        with schema_editor.connection.cursor() as cursor:
+            cursor.execute(REFERRAL_TREE_SQL)
+        return
+
+    parents = dict(RegisteredUser.objects.values_list('id', 'referred_by_id').iterator())
+    by_path = defaultdict(list)
+    descendants = dict.fromkeys(parents, 0)
+    for user_id in parents:
+        chain = []
+        ancestor = parents[user_id]
+        while ancestor is not None and ancestor not in chain:
+            chain.append(ancestor)
+            ancestor = parents.get(ancestor)
+        for ancestor in chain:
+            descendants[ancestor] += 1
+        if chain:
+            by_path[''.join('{}/'.format(ancestor) for ancestor in reversed(chain))].append(user_id)
+
+    # siblings share a path and many users share a descendant count, so one UPDATE covers each group
+    by_count = defaultdict(list)
+    for user_id, count in descendants.items():
+        if count:
+            by_count[count].append(user_id)
+    for path, user_ids in by_path.items():
+        for start in range(0, len(user_ids), BATCH_SIZE):
+            RegisteredUser.objects.filter(id__in=user_ids[start:start + BATCH_SIZE]).update(
+                referral_path=path, depth=path.count('/'))
+    for count, user_ids in by_count.items():
+        for start in range(0, len(user_ids), BATCH_SIZE):
+            RegisteredUser.objects.filter(id__in=user_ids[start:start + BATCH_SIZE]).update(descendant_count=count)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('referrals', '0009_leaderboard_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='registereduser',
+            name='depth',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='registereduser',
+            name='descendant_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='registereduser',
+            name='referral_path',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.RunPython(populate_referral_tree, migrations.RunPython.noop),
+    ]
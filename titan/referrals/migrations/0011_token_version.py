@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.3 on 2026-10-18 12:28
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('referrals', '0010_referral_tree'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='registereduser',
+            name='token_version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
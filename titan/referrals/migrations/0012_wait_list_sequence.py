@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.3 on 2026-10-18 12:49
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import F, Max
+
+
+def create_wait_list_sequence(apps, schema_editor):
+    """
+    On PostgreSQL wait-list positions now come from a database sequence, and rank_version holds
+    transaction ids: the positions stamped so far would be read again by every sync.
+    """
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    RegisteredUser = apps.get_model('referrals', 'RegisteredUser')
+    Sequence = apps.get_model('referrals', 'Sequence')
+
+    last = max(Sequence.objects.filter(name='wait_list').values_list('value', flat=True).first() or 0,
+               RegisteredUser.objects.aggregate(last=Max('wait_list_position'))['last'] or 0)
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute('CREATE SEQUENCE referrals_wait_list_seq')
+        cursor.execute("SELECT setval('referrals_wait_list_seq', %s, %s)", [max(last, 1), last > 0])
+    RegisteredUser.objects.exclude(rank_version=0).update(rank_version=0)
+
+
+def drop_wait_list_sequence(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    RegisteredUser = apps.get_model('referrals', 'RegisteredUser')
+    Sequence = apps.get_model('referrals', 'Sequence')
+
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute('SELECT CASE WHEN is_called THEN last_value ELSE 0 END FROM referrals_wait_list_seq')
+        last = cursor.fetchone()[0]
+        cursor.execute('DROP SEQUENCE referrals_wait_list_seq')
+    Sequence.objects.update_or_create(name='wait_list', defaults={'value': last})
+    RegisteredUser.objects.exclude(wait_list_position=None).update(rank_version=F('wait_list_position'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('referrals', '0011_token_version'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='registereduser',
+            name='rank_version',
+            field=models.BigIntegerField(db_index=True, default=0),
+        ),
+        migrations.RunPython(create_wait_list_sequence, drop_wait_list_sequence),
+    ]
@@ -1,11 +1,371 @@
-from django.db import models
+import random
+
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives
+from django.db import IntegrityError, connections, models, router, transaction
+from django.db.models import F, Sum
+from django.utils import timezone
+
+from referrals.codes import MAX_ATTEMPTS, referral_code_for
+
+
+class Sequence(models.Model):
+    WAIT_LIST = 'wait_list'
+
+    name = models.CharField(max_length=32, primary_key=True)
+    value = models.BigIntegerField(default=0)
+
+    @classmethod
+    def next_value(cls, name):
+        return cls.reserve(name, 1)[0]
+
+    @classmethod
+    def reserve(cls, name, count):
+        """
+        `count` new values, ascending. On PostgreSQL they come from the database sequence
+        `referrals_<name>_seq`, which never blocks: concurrent transactions interleave their values
+        and a rollback loses them, so there are gaps. Elsewhere they are consecutive values of this
+        table's row, which stays locked until the surrounding transaction ends.
+        """
+        connection = connections[router.db_for_write(cls)]
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT nextval(%s) FROM generate_series(1, %s)', [cls.sequence_name(name), count])
+                return sorted(row[0] for row in cursor.fetchall())
+
+        if not cls.objects.filter(name=name).update(value=F('value') + count):
+            cls.objects.get_or_create(name=name)
+            cls.objects.filter(name=name).update(value=F('value') + count)
+        last = cls.objects.values_list('value', flat=True).get(name=name)
+        return list(range(last - count + 1, last + 1))
+
+    @classmethod
+    def set_value(cls, name, value):
+        """
+        Makes `value` the last value handed out.
+        """
+        connection = connections[router.db_for_write(cls)]
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT setval(%s, %s, %s)', [cls.sequence_name(name), max(value, 1), value > 0])
+        else:
+            cls.objects.update_or_create(name=name, defaults={'value': value})
+
+    @staticmethod
+    def sequence_name(name):
+        return 'referrals_{}_seq'.format(name)
+
+    def __str__(self):
+        return '{}={}'.format(self.name, self.value)
+
+
+class CounterShard(models.Model):
+    """
+    One slice of a named counter. Writers bump a random shard, readers sum all of them.
+    """
+    TOTAL_REGISTERED = 'total_registered'
+
+    name = models.CharField(max_length=32)
+    shard = models.PositiveSmallIntegerField()
+    value = models.BigIntegerField(default=0)
+
+    class Meta:
+        unique_together = ('name', 'shard')
+
+    @classmethod
+    def increment(cls, name, delta=1):
+        """
+        Runs in the caller's transaction, so the increment commits or rolls back with it.
+        """
+        shard = random.randrange(getattr(settings, 'COUNTER_SHARDS', 8))
+        if not cls.objects.filter(name=name, shard=shard).update(value=F('value') + delta):
+            cls.objects.get_or_create(name=name, shard=shard)
+            cls.objects.filter(name=name, shard=shard).update(value=F('value') + delta)
+
+    @classmethod
+    def get_value(cls, name):
+        return cls.objects.filter(name=name).aggregate(value=Sum('value'))['value'] or 0
+
+    @classmethod
+    def set_value(cls, name, value):
+        cls.objects.filter(name=name).exclude(shard=0).update(value=0)
+        cls.objects.update_or_create(name=name, shard=0, defaults={'value': value})
+
+    def __str__(self):
+        return '{}[{}]={}'.format(self.name, self.shard, self.value)
+
+
+# Inserts the user, credits the referrer, queues the new descendant for the ancestors (see
+# referrals.tree) and bumps total_registered in one round trip. Any unique violation (email, or a
+# clash with a legacy referral code) makes it return no rows instead of failing. Changed rows are
+# stamped with the transaction id, see referrals.ranking.
+REGISTER_SQL = '''
+WITH referrer AS (
+    SELECT id, referral_path, depth FROM referrals_registereduser WHERE referral_code = %(referrer_code)s
+), inserted AS (
+    INSERT INTO referrals_registereduser
+        (registration_datetime, wait_list_position, email, referral_code, referral_count, referred_by_id, rank_version,
+         referral_path, depth, descendant_count, token_version)
+    SELECT %(now)s, %(position)s, %(email)s, %(code)s, 0, referrer.id, txid_current(),
+           COALESCE(referrer.referral_path || referrer.id || '/', ''), COALESCE(referrer.depth + 1, 0), 0, 0
+    FROM (SELECT 1) AS one LEFT JOIN referrer ON true
+    WHERE %(referrer_code)s::varchar IS NULL OR referrer.id IS NOT NULL
+    ON CONFLICT DO NOTHING
+    RETURNING id, referred_by_id, referral_path, depth, rank_version
+), credited AS (
+    UPDATE referrals_registereduser AS credited_user
+    SET referral_count = credited_user.referral_count + 1, rank_version = txid_current()
+    FROM inserted
+    WHERE credited_user.id = inserted.referred_by_id
+    RETURNING credited_user.id, credited_user.email, credited_user.referral_code
+), queued AS (
+    INSERT INTO referrals_pendingdescendant (referral_path)
+    SELECT referral_path FROM inserted WHERE referred_by_id IS NOT NULL
+), counted AS (
+    INSERT INTO referrals_countershard (name, shard, value)
+    SELECT %(counter)s, %(shard)s, 1 FROM inserted
+    ON CONFLICT (name, shard) DO UPDATE SET value = referrals_countershard.value + 1
+)
+SELECT inserted.id, inserted.referred_by_id, inserted.referral_path, inserted.depth, inserted.rank_version,
+       (SELECT COALESCE(SUM(value), 0) FROM referrals_countershard WHERE name = %(counter)s),
+       (SELECT json_build_array(id, email, referral_code) FROM credited)
+FROM inserted
+'''
+
+
+def ancestor_ids(referral_path):
+    return [int(ancestor) for ancestor in referral_path.split('/') if ancestor]
+
+
+def rank_stamp(using, position):
+    """
+    rank_version of the rows changed by the current transaction of `using`, registering `position`:
+    its transaction id on PostgreSQL, where registrations commit in any order, elsewhere the position
+    itself, since the locked sequence row makes positions commit in order there.
+    """
+    connection = connections[using]
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT txid_current()')
+            return cursor.fetchone()[0]
+    return position
+
+
+class RegisteredUserQuerySet(models.QuerySet):
+    def register(self, email, referrer_code=None):
+        """
+        Creates a user, optionally referred by the owner of `referrer_code`, and returns it with
+        total_registered set and referred_by loaded. Raises IntegrityError if the email is taken and DoesNotExist if the
+        referral code is unknown, so the caller's transaction rolls back.
+        """
+        db = router.db_for_write(self.model)
+        with transaction.atomic(using=db, savepoint=False):
+            if connections[db].vendor == 'postgresql':
+                return self._register_with_upsert(db, email, referrer_code)
+            referred_by = self.get(referral_code=referrer_code) if referrer_code is not None else None
+            user = self.create(email=email, referred_by=referred_by)
+            user.total_registered = CounterShard.get_value(CounterShard.TOTAL_REGISTERED)
+            return user
+
+    def _register_with_upsert(self, db, email, referrer_code):
+        position = Sequence.next_value(Sequence.WAIT_LIST)
+        now = timezone.now()
+        for attempt in range(MAX_ATTEMPTS):
+            code = referral_code_for(position, attempt)
+            with connections[db].cursor() as cursor:
+                cursor.execute(REGISTER_SQL, {
+                    'referrer_code': referrer_code,
+                    'now': now,
+                    'position': position,
+                    'email': email,
+                    'code': code,
+                    'counter': CounterShard.TOTAL_REGISTERED,
+                    'shard': random.randrange(getattr(settings, 'COUNTER_SHARDS', 8)),
+                })
+                row = cursor.fetchone()
+            if row is not None:
+                break
+            if referrer_code is not None and not self.filter(referral_code=referrer_code).exists():
+                raise self.model.DoesNotExist('No user with referral code {}'.format(referrer_code))
+            if self.filter(email=email).exists():
+                raise IntegrityError('{} is already registered'.format(email))
+            if self.filter(wait_list_position=position).exists():
+                raise IntegrityError('Wait-list position {} is already taken'.format(position))
+            # Only codes drawn at random before codes were derived from positions can clash.
+            if not self.filter(referral_code=code).exists():
+                raise IntegrityError('Could not register {}'.format(email))
+        else:
+            raise IntegrityError('No free referral code for position {}'.format(position))
+
+        user_id, referrer_id, referral_path, depth, rank_version, total_registered, referrer = row
+        values = {
+            'id': user_id,
+            'registration_datetime': now,
+            'wait_list_position': position,
+            'email': email,
+            'referred_by_id': referrer_id,
+            'referral_code': code,
+            'referral_count': 0,
+            'rank_version': rank_version,
+            'referral_path': referral_path,
+            'depth': depth,
+            'descendant_count': 0,
+            'token_version': 0,
+        }
+        fields = [f.attname for f in self.model._meta.concrete_fields if f.attname in values]
+        user = self.model.from_db(db, fields, [values[field] for field in fields])
+        if referrer is not None:
+            user.referred_by = self.model.from_db(db, ['id', 'email', 'referral_code'], referrer)
+        # The statement's own snapshot does not include the shard it just bumped.
+        user.total_registered = total_registered + 1
+        return user
+
 
 class RegisteredUser(models.Model):
-    registration_datetime = models.DateTimeField(auto_now=True)
+    registration_datetime = models.DateTimeField(auto_now_add=True)
+    wait_list_position = models.PositiveIntegerField(unique=True, null=True, default=None)
 
     email = models.EmailField(unique=True)
     referred_by = models.ForeignKey("RegisteredUser", null=True, default=None, related_name='registered_users')
-    referral_code = models.CharField(max_length=8, null=True, default=None)
+    referral_code = models.CharField(max_length=8, unique=True, null=True, default=None)
+    referral_count = models.PositiveIntegerField(default=0)
+    # Stamp of the registration that last changed this row, see rank_stamp and referrals.ranking.
+    rank_version = models.BigIntegerField(default=0, db_index=True)
+    # Ids of all referrers up the chain, root first, each followed by '/'.
+    referral_path = models.TextField(default='', blank=True)
+    depth = models.PositiveIntegerField(default=0)
+    descendant_count = models.PositiveIntegerField(default=0)
+    # Part of every session token, see referrals.sessions.
+    token_version = models.PositiveIntegerField(default=0)
+
+    objects = RegisteredUserQuerySet.as_manager()
+
+    class Meta:
+        # referrals.leaderboard
+        indexes = [models.Index(fields=['-referral_count', 'wait_list_position'])]
+
+    def save(self, *args, **kwargs):
+        adding = self._state.adding
+        if adding and self.wait_list_position is None:
+            self.wait_list_position = Sequence.next_value(Sequence.WAIT_LIST)
+        if adding:
+            self.rank_version = rank_stamp(kwargs.get('using') or router.db_for_write(RegisteredUser),
+                                           self.wait_list_position)
+        if adding and self.referred_by_id is not None:
+            self.referral_path = '{}{}/'.format(self.referred_by.referral_path, self.referred_by_id)
+            self.depth = self.referred_by.depth + 1
+        if adding and self.referral_code is None:
+            self._insert_with_referral_code(*args, **kwargs)
+        else:
+            super().save(*args, **kwargs)
+        if adding:
+            CounterShard.increment(CounterShard.TOTAL_REGISTERED)
+            if self.referred_by_id is not None:
+                RegisteredUser.objects.filter(pk=self.referred_by_id).update(
+                    referral_count=F('referral_count') + 1, rank_version=self.rank_version)
+                PendingDescendant.objects.create(referral_path=self.referral_path)
+
+    def revoke_tokens(self):
+        RegisteredUser.objects.filter(pk=self.pk).update(token_version=F('token_version') + 1)
+        self.token_version += 1
+
+    def ancestor_ids(self):
+        return ancestor_ids(self.referral_path)
+
+    def _insert_with_referral_code(self, *args, **kwargs):
+        for attempt in range(MAX_ATTEMPTS):
+            self.referral_code = referral_code_for(self.wait_list_position, attempt)
+            try:
+                with transaction.atomic():
+                    return super().save(*args, **kwargs)
+            except IntegrityError:
+                # Only codes drawn at random before codes were derived from positions can clash.
+                if not RegisteredUser.objects.filter(referral_code=self.referral_code).exists():
+                    raise
+        raise IntegrityError('No free referral code for position {}'.format(self.wait_list_position))
 
     def __str__(self):
         return self.email
+
+
+class OutboundEmail(models.Model):
+    """
+    Emails are written here in the request's transaction and sent later by `manage.py send_outbox`,
+    so SMTP latency or failures never affect a registration.
+    """
+    subject = models.CharField(max_length=255)
+    message = models.TextField()
+    html_message = models.TextField(blank=True)
+    from_email = models.CharField(max_length=254, blank=True)
+    recipient = models.EmailField()
+
+    created = models.DateTimeField(auto_now_add=True)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    sent_at = models.DateTimeField(null=True, default=None)
+    last_error = models.TextField(blank=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['sent_at', 'next_attempt_at'])]
+
+    @classmethod
+    def compose(cls, subject, message, html_message, recipient):
+        """
+        Unsaved email, for callers queueing many at once with bulk_create.
+        """
+        return cls(subject=subject, message=message, html_message=html_message,
+                   from_email=settings.DEFAULT_FROM_EMAIL, recipient=recipient)
+
+    @classmethod
+    def enqueue(cls, subject, message, html_message, recipient):
+        email = cls.compose(subject, message, html_message, recipient)
+        email.save()
+        return email
+
+    def to_message(self, connection=None):
+        email = EmailMultiAlternatives(self.subject, self.message, self.from_email or None, [self.recipient],
+                                       connection=connection)
+        if self.html_message:
+            email.attach_alternative(self.html_message, 'text/html')
+        return email
+
+    def __str__(self):
+        return '{} to {}'.format(self.subject, self.recipient)
+
+
+class ReferrerDigest(models.Model):
+    """
+    Referrals not yet reported to the referrer, see referrals.emails.notify_referrer_of_signup.
+    """
+    referrer = models.OneToOneField(RegisteredUser, primary_key=True, related_name='digest')
+    referrals = models.PositiveIntegerField(default=0)
+    first_referral_at = models.DateTimeField(default=timezone.now, db_index=True)
+    base_url = models.CharField(max_length=255)
+
+    @classmethod
+    def add(cls, referrer_id, base_url, referrals=1):
+        added = cls.objects.filter(referrer_id=referrer_id).update(
+            referrals=F('referrals') + referrals, base_url=base_url)
+        if not added:
+            try:
+                with transaction.atomic():
+                    cls.objects.create(referrer_id=referrer_id, referrals=referrals, base_url=base_url)
+            except IntegrityError:
+                cls.objects.filter(referrer_id=referrer_id).update(
+                    referrals=F('referrals') + referrals, base_url=base_url)
+
+    def __str__(self):
+        return '{} referrals for {}'.format(self.referrals, self.referrer_id)
+
+
+class PendingDescendant(models.Model):
+    """
+    A join not yet counted in its ancestors' descendant_count, see referrals.tree.
+    """
+    referral_path = models.TextField()
+
+    def ancestor_ids(self):
+        return ancestor_ids(self.referral_path)
+
+    def __str__(self):
+        return self.referral_path
@@ -0,0 +1,72 @@
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail import get_connection
+from django.db import transaction
+from django.utils import timezone
+
+from referrals import metrics
+from referrals.models import OutboundEmail
+
+
+def retry_delay(attempts):
+    """
+    Exponential backoff: EMAIL_OUTBOX_RETRY_DELAY seconds after the first failure, doubling after each
+    following one, capped at EMAIL_OUTBOX_MAX_RETRY_DELAY.
+    """
+    base = getattr(settings, 'EMAIL_OUTBOX_RETRY_DELAY', 60)
+    return min(base * 2 ** (attempts - 1), getattr(settings, 'EMAIL_OUTBOX_MAX_RETRY_DELAY', 3600))
+
+
+def pending_emails():
+    return OutboundEmail.objects.filter(
+        sent_at__isnull=True,
+        next_attempt_at__lte=timezone.now(),
+        attempts__lt=getattr(settings, 'EMAIL_OUTBOX_MAX_ATTEMPTS', 8),
+    )
+
+
+def send_batch(batch_size=None):
+    """
+    Sends up to batch_size due emails over a single connection of settings.EMAIL_BACKEND and
+    returns how many were handled. Rows are locked with SKIP LOCKED, so several workers can drain
+    the outbox side by side.
+    """
+    batch_size = batch_size or getattr(settings, 'EMAIL_OUTBOX_BATCH_SIZE', 50)
+    with transaction.atomic():
+        emails = list(pending_emails().select_for_update(skip_locked=True).order_by('next_attempt_at')[:batch_size])
+        if not emails:
+            return 0
+
+        connection = get_connection(fail_silently=False)
+        try:
+            connection.open()
+        except Exception as e:
+            for email in emails:
+                _mark_failed(email, e)
+            return len(emails)
+
+        try:
+            for email in emails:
+                start = time.perf_counter()
+                try:
+                    connection.send_messages([email.to_message(connection=connection)])
+                except Exception as e:
+                    metrics.emails_sent.inc(('failed',))
+                    _mark_failed(email, e)
+                else:
+                    metrics.email_send_duration.observe((), time.perf_counter() - start)
+                    metrics.emails_sent.inc(('sent',))
+                    email.sent_at = timezone.now()
+                    email.save(update_fields=['sent_at'])
+        finally:
+            connection.close()
+    return len(emails)
+
+
+def _mark_failed(email, error):
+    email.attempts += 1
+    email.next_attempt_at = timezone.now() + timedelta(seconds=retry_delay(email.attempts))
+    email.last_error = repr(error)
+    email.save(update_fields=['attempts', 'next_attempt_at', 'last_error'])
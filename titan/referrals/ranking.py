@@ -0,0 +1,266 @@
+"""
+The wait list as shown to users. Positions are handed out without a lock, so they have gaps (see
+Sequence.reserve); the place shown is the user's rank among registered users instead. With
+WAIT_LIST_RANKING = 'referrals' every credited referral also moves a user WAIT_LIST_REFERRAL_BOOST
+places up the queue, i.e. users are ordered by
+(wait_list_position - boost * referral_count, wait_list_position); in sign-up order the boost is 0.
+
+Each worker keeps these keys in a RankIndex answering rank queries in O(log n) and catches up with
+registrations made by other workers through the indexed rank_version column: a registration stamps
+both its own row and its referrer's with models.rank_stamp. On PostgreSQL that is the transaction id,
+and every transaction still running when a sync starts has an id of at least the snapshot's xmin,
+so the next sync reads the rows stamped from that xmin on (a long-running transaction anywhere holds
+it back, making syncs re-read more rows meanwhile). Elsewhere positions commit in order and the
+stamp is the position, so the next sync reads the rows above the highest stamp seen. Anything
+changing referral counts or positions in another way (reconcile_counters, edits by hand) must call
+`reset()`, which makes every worker reload the whole table.
+"""
+import bisect
+import logging
+import threading
+import time
+
+import numpy as np
+from django.conf import settings
+from django.db import DatabaseError, connections, router, transaction
+from django.db.models import F, Q
+
+from referrals import cache as shared_cache
+from referrals.models import RegisteredUser
+
+logger = logging.getLogger(__name__)
+
+GENERATION_KEY = 'referrals:ranking:generation'
+
+
+def enabled():
+    return getattr(settings, 'WAIT_LIST_RANKING', 'signup') == 'referrals'
+
+
+def boost():
+    return getattr(settings, 'WAIT_LIST_REFERRAL_BOOST', 10) if enabled() else 0
+
+
+def sync_horizon(using):
+    """
+    Lowest rank_version a row committed after this call can have, or None where that is simply
+    above the highest one read.
+    """
+    connection = connections[using]
+    if connection.vendor != 'postgresql':
+        return None
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT txid_snapshot_xmin(txid_current_snapshot())')
+        return cursor.fetchone()[0]
+
+
+def count_rank(position, referral_count):
+    """
+    What RankIndex.rank answers, counted by the database instead.
+    """
+    score = position - boost() * referral_count
+    ahead = RegisteredUser.objects.annotate(score=F('wait_list_position') - boost() * F('referral_count')) \
+        .filter(Q(score__lt=score) | Q(score=score, wait_list_position__lt=position))
+    return ahead.count() + 1
+
+
+class RankIndex(object):
+    """
+    Order statistics over the keys (score, position), score = position - boost * referral_count.
+    A Fenwick tree counts the users of every score; users sharing a score are told apart by their
+    positions, kept in `single` for the usual lone user and in `ties` for the others. Scores outside
+    the covered range rebuild everything in O(n), with enough margin to make that rare.
+    """
+    def __init__(self, boost, positions=(), referral_counts=()):
+        self.boost = boost
+        positions = np.asarray(positions, dtype=np.int64)
+        # referral_count by position, -1 where there is no user
+        self.counts = np.full(int(positions.max()) + 1 if len(positions) else 1, -1, dtype=np.int64)
+        self.counts[positions] = referral_counts
+        self.rebuild()
+
+    def __len__(self):
+        return self.prefix(self.size)
+
+    def rebuild(self):
+        positions = np.flatnonzero(self.counts >= 0)
+        scores = positions - self.boost * self.counts[positions]
+        low = int(scores.min()) if len(scores) else 0
+        # new users score up to their own position
+        high = max(int(scores.max()) if len(scores) else 0, len(self.counts))
+        margin = max(1024, (high - low) // 2)
+        self.low = low - margin
+        self.size = high + margin - self.low
+
+        slots = scores - self.low
+        cumulative = np.concatenate(([0], np.cumsum(np.bincount(slots, minlength=self.size))))
+        index = np.arange(1, self.size + 1)
+        self.tree = np.zeros(self.size + 1, dtype=np.int64)
+        self.tree[1:] = cumulative[index] - cumulative[index - (index & -index)]
+
+        order = np.lexsort((positions, slots))
+        slots, positions = slots[order], positions[order]
+        self.single = np.zeros(self.size, dtype=np.int64)
+        self.ties = {}
+        if len(slots):
+            starts = np.flatnonzero(np.concatenate(([True], slots[1:] != slots[:-1])))
+            sizes = np.diff(np.concatenate((starts, [len(slots)])))
+            lone = starts[sizes == 1]
+            self.single[slots[lone]] = positions[lone]
+            for start, count in zip(starts[sizes > 1].tolist(), sizes[sizes > 1].tolist()):
+                self.ties[int(slots[start])] = positions[start:start + count].tolist()
+
+    def prefix(self, slot):
+        """
+        Number of users in slots below `slot`.
+        """
+        total = 0
+        tree = self.tree
+        while slot > 0:
+            total += int(tree[slot])
+            slot -= slot & -slot
+        return total
+
+    def _add(self, slot, delta):
+        tree, size = self.tree, self.size
+        slot += 1
+        while slot <= size:
+            tree[slot] += delta
+            slot += slot & -slot
+
+    def rank(self, position, referral_count):
+        """
+        1-based place in the queue of a user with these values, whether or not they are indexed.
+        """
+        slot = position - self.boost * referral_count - self.low
+        if slot < 0:
+            return 1
+        if slot >= self.size:
+            return len(self) + 1
+        ahead = self.prefix(slot)
+        if slot in self.ties:
+            ahead += bisect.bisect_left(self.ties[slot], position)
+        elif 0 < self.single[slot] < position:
+            ahead += 1
+        return ahead + 1
+
+    def set(self, position, referral_count):
+        if position >= len(self.counts):
+            grown = np.full(max(position + 1, 2 * len(self.counts)), -1, dtype=np.int64)
+            grown[:len(self.counts)] = self.counts
+            self.counts = grown
+        previous = int(self.counts[position])
+        if previous == referral_count:
+            return
+        self.counts[position] = referral_count
+        slot = position - self.boost * referral_count - self.low
+        if not 0 <= slot < self.size:
+            self.rebuild()
+            return
+        if previous >= 0:
+            self._unlink(position - self.boost * previous - self.low, position)
+        self._link(slot, position)
+
+    def _link(self, slot, position):
+        if slot in self.ties:
+            bisect.insort(self.ties[slot], position)
+        elif self.single[slot]:
+            self.ties[slot] = sorted((int(self.single[slot]), position))
+            self.single[slot] = 0
+        else:
+            self.single[slot] = position
+        self._add(slot, 1)
+
+    def _unlink(self, slot, position):
+        tied = self.ties.get(slot)
+        if tied is None:
+            self.single[slot] = 0
+        else:
+            tied.remove(position)
+            if len(tied) == 1:
+                self.single[slot] = tied[0]
+                del self.ties[slot]
+        self._add(slot, -1)
+
+
+class Ranking(object):
+    """
+    The RankIndex of this process, brought up to date at most every WAIT_LIST_RANK_SYNC_INTERVAL
+    seconds. It is never synced inside a transaction: that would read the transaction's own
+    uncommitted rows, and if it rolled back, a later registration reusing its position would be
+    skipped. Until the first sync succeeds, ranks are counted by the database.
+    """
+    def __init__(self):
+        self.index = None
+        # rows with a rank_version of at least this may not be in the index yet
+        self.version = 0
+        self.generation = None
+        self.checked_at = 0
+        self.lock = threading.Lock()
+
+    def rank(self, position, referral_count):
+        self.sync()
+        if self.index is None:
+            return count_rank(position, referral_count)
+        return self.index.rank(position, referral_count)
+
+    def sync(self):
+        if self.index is not None and \
+                time.monotonic() - self.checked_at < getattr(settings, 'WAIT_LIST_RANK_SYNC_INTERVAL', 1):
+            return
+        if transaction.get_connection().in_atomic_block:
+            return
+        with self.lock:
+            generation = shared_cache.get_cache().get(GENERATION_KEY)
+            # the horizon and the rows must come from the same database
+            using = router.db_for_read(RegisteredUser)
+            horizon = sync_horizon(using)
+            if self.index is None or generation != self.generation or boost() != self.index.boost:
+                versions = self.load(using, boost())
+                self.generation = generation
+                self.version = 0
+            else:
+                changed = RegisteredUser.objects.using(using).filter(rank_version__gte=self.version) \
+                    .exclude(wait_list_position=None) \
+                    .values_list('wait_list_position', 'referral_count', 'rank_version')
+                versions = []
+                for position, referral_count, version in changed:
+                    self.index.set(position, referral_count)
+                    versions.append(version)
+            if horizon is not None:
+                self.version = horizon
+            elif len(versions):
+                self.version = max(self.version, int(max(versions)) + 1)
+            self.checked_at = time.monotonic()
+
+    def load(self, using, boost):
+        """
+        Rebuilds the index, returning the rank_version of every row read.
+        """
+        rows = RegisteredUser.objects.using(using).exclude(wait_list_position=None) \
+            .values_list('wait_list_position', 'referral_count', 'rank_version')
+        positions, referral_counts, versions = (np.array(column, dtype=np.int64) for column in zip(*rows)) \
+            if rows else ((), (), ())
+        self.index = RankIndex(boost, positions, referral_counts)
+        return versions
+
+
+ranking = Ranking()
+
+
+def wait_list_rank(position, referral_count):
+    return ranking.rank(position, referral_count)
+
+
+def reset():
+    """
+    Makes every worker reload its index on its next sync.
+    """
+    shared_cache.get_cache().set(GENERATION_KEY, time.time(), None)
+
+
+def warm_up():
+    try:
+        ranking.sync()
+    except DatabaseError:
+        logger.warning('Could not load the wait list ranking', exc_info=True)
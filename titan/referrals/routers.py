@@ -0,0 +1,59 @@
+"""
+Reads go to the DATABASE_REPLICAS, writes and everything inside a transaction to the primary
+('default'). A client that wrote something keeps reading from the primary for REPLICA_PIN_SECONDS,
+so it never sees a replica that has not caught up with its own write (e.g. a 404 for the user it
+just registered).
+"""
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.utils.deprecation import MiddlewareMixin
+
+PIN_COOKIE = 'primary_until'
+
+state = threading.local()
+
+
+def replicas():
+    return getattr(settings, 'DATABASE_REPLICAS', [])
+
+
+class PrimaryReplicaRouter(object):
+    def db_for_read(self, model, **hints):
+        if not replicas() or getattr(state, 'pinned', False) or connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        return random.choice(replicas())
+
+    def db_for_write(self, model, **hints):
+        state.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == DEFAULT_DB_ALIAS
+
+
+class ReplicaPinningMiddleware(MiddlewareMixin):
+    """
+    Pins unsafe requests, and requests of clients that wrote in the last REPLICA_PIN_SECONDS, to the
+    primary.
+    """
+    def process_request(self, request):
+        try:
+            pinned_until = float(request.COOKIES.get(PIN_COOKIE, 0))
+        except ValueError:
+            pinned_until = 0
+        state.pinned = request.method not in ('GET', 'HEAD', 'OPTIONS') or pinned_until > time.time()
+        state.wrote = False
+
+    def process_response(self, request, response):
+        if getattr(state, 'wrote', False) and replicas():
+            seconds = getattr(settings, 'REPLICA_PIN_SECONDS', 5)
+            response.set_cookie(PIN_COOKIE, str(time.time() + seconds), max_age=seconds, httponly=True)
+        state.pinned = state.wrote = False
+        return response
@@ -0,0 +1,114 @@
+"""
+Who is logged in. By default (SESSION_MODE = 'database') that is the email stored in the
+django.contrib.sessions session. With SESSION_MODE = 'token' it is a signed token carrying the user's
+id, sent back as a cookie or as an `Authorization: Bearer` header, so no session row is read or
+written and the user is found by primary key.
+
+Tokens are signed with the first of SESSION_TOKEN_KEYS and accepted with any of them, expire after
+SESSION_TOKEN_MAX_AGE seconds and are reissued once older than SESSION_TOKEN_ROTATE_AFTER or signed
+with an older key. They also carry the user's token_version, so `RegisteredUser.revoke_tokens()`
+invalidates every token issued so far. A client still holding a database session gets a token
+instead on its first request, and its session row is deleted.
+"""
+import time
+
+from django.conf import settings
+from django.core.signing import BadSignature, Signer
+
+from referrals.models import RegisteredUser
+
+SALT = 'referrals.sessions'
+TOKEN_HEADER = 'X-Session-Token'
+
+
+def enabled():
+    return getattr(settings, 'SESSION_MODE', 'database') == 'token'
+
+
+def signing_keys():
+    return getattr(settings, 'SESSION_TOKEN_KEYS', None) or [settings.SECRET_KEY]
+
+
+def cookie_name():
+    return getattr(settings, 'SESSION_TOKEN_COOKIE_NAME', 'titan_token')
+
+
+def issue(user):
+    value = '{}:{}:{}'.format(user.pk, user.token_version, int(time.time()))
+    return Signer(signing_keys()[0], salt=SALT).sign(value)
+
+
+def decode(token):
+    """
+    (user id, token version, whether to reissue), raises BadSignature for invalid or expired tokens.
+    """
+    for index, key in enumerate(signing_keys()):
+        try:
+            value = Signer(key, salt=SALT).unsign(token)
+            break
+        except BadSignature:
+            continue
+    else:
+        raise BadSignature('Invalid session token')
+    user_id, version, issued_at = (int(part) for part in value.split(':'))
+    age = time.time() - issued_at
+    if age > getattr(settings, 'SESSION_TOKEN_MAX_AGE', settings.SESSION_COOKIE_AGE):
+        raise BadSignature('Session token expired')
+    return user_id, version, index > 0 or age > getattr(settings, 'SESSION_TOKEN_ROTATE_AFTER', 86400)
+
+
+def get_token(request):
+    authorization = request.META.get('HTTP_AUTHORIZATION', '')
+    if authorization.startswith('Bearer '):
+        return authorization[len('Bearer '):]
+    return request.COOKIES.get(cookie_name())
+
+
+def set_token(response, user):
+    token = issue(user)
+    response.set_cookie(cookie_name(), token, max_age=getattr(settings, 'SESSION_TOKEN_MAX_AGE', settings.SESSION_COOKIE_AGE),
+                        secure=settings.SESSION_COOKIE_SECURE, httponly=True)
+    response[TOKEN_HEADER] = token
+
+
+def log_in(request, response, email, user=None):
+    """
+    Remembers that the client is the user with `email`; passing the user saves a lookup in token mode.
+    """
+    if not enabled():
+        request.session['email'] = email
+        return
+    if user is None:
+        user = RegisteredUser.objects.only('token_version').get(email=email)
+    set_token(response, user)
+
+
+def token_user(request):
+    """
+    (user, whether to reissue their token) for the request, or (None, False).
+    """
+    token = get_token(request)
+    if token:
+        try:
+            user_id, version, reissue = decode(token)
+        except (BadSignature, ValueError):
+            return None, False
+        user = RegisteredUser.objects.filter(pk=user_id, token_version=version).first()
+        return user, reissue and user is not None
+
+    if settings.SESSION_COOKIE_NAME in request.COOKIES and hasattr(request, 'session'):
+        email = request.session.get('email')
+        request.session.flush()
+        user = RegisteredUser.objects.filter(email=email).first() if email else None
+        return user, user is not None
+    return None, False
+
+
+def log_out(request, response):
+    if not enabled():
+        request.session.flush()
+        return
+    user, _ = token_user(request)
+    if user is not None:
+        user.revoke_tokens()
+    response.delete_cookie(cookie_name())
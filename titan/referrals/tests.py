@@ -1,7 +1,68 @@
+import base64
+import datetime
+import gzip
+import json
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
+
+import numpy as np
+from django.conf import settings
+from django.contrib.auth.models import User
 from django.contrib.sessions.models import Session
-from rest_framework.test import APITestCase
+from django.core import mail
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import DEFAULT_DB_ALIAS, connection, connections, transaction
+from django.http import HttpResponse
+from django.shortcuts import get_object_or_404
+from django.test import Client, RequestFactory, SimpleTestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework import test
+
+from referrals import cache as shared_cache, charts, leaderboard, metrics, ranking, routers, sessions
+from referrals.codes import DOMAIN, MAX_ATTEMPTS, encode, permute, referral_code_for
+from referrals.models import CounterShard, OutboundEmail, PendingDescendant, ReferrerDigest, RegisteredUser, Sequence
+from referrals.emails import flush_referrer_digests
+from referrals.management.commands import import_registrations
+from referrals.outbox import send_batch
+from referrals.tree import flush_descendant_counts
+
+LOCAL_CACHE = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'tests'}}
+
 
-from referrals.models import RegisteredUser
+@override_settings(CACHES=LOCAL_CACHE)
+class APITestCase(test.APITestCase):
+    """
+    Every test starts with an empty cache, so payloads cached by one test never leak into the next,
+    and with wait-list positions starting at 1 again.
+    """
+    def _pre_setup(self):
+        super()._pre_setup()
+        cache.clear()
+        # a PostgreSQL sequence ignores the rollback of the previous test
+        Sequence.set_value(Sequence.WAIT_LIST, 0)
+
+    def load_ranking(self):
+        """
+        Ranks from an index of the users created so far, as a worker serves them once warmed up. The
+        ranking is never synced inside the test's transaction, so it would count every rank in SQL.
+        """
+        loaded = ranking.Ranking()
+        loaded.load(DEFAULT_DB_ALIAS, ranking.boost())
+        patcher = mock.patch.object(ranking, 'ranking', loaded)
+        patcher.start()
+        self.addCleanup(patcher.stop)
 
 
 class NewUserJoinTestCase(APITestCase):
@@ -72,8 +133,15 @@ class ReferralUserJoinTestCase(APITestCase):
         assert RegisteredUser.objects.count() == 1
         response = self.client.post(self.url, {'email': 'test@email.com'})
         assert response.status_code == 400
+        assert response.data == {'email': ['This field must be unique.']}
         assert RegisteredUser.objects.count() == 1
 
+    def test_invalid_referral_code_takes_precedence_over_invalid_email(self):
+        response = self.client.post('/api/join/INVALID/', {'email': 'invalid-email.com'})
+        assert response.status_code == 404
+        response = self.client.post('/api/join/INVALID/', {'email': 'test@email.com'})
+        assert response.status_code == 404
+
 
     def test_after_registration_user_gets_referral_code(self):
         self.client.post(self.url, {'email': 'valid@email.com'})
@@ -142,3 +210,1163 @@ class LoginUserDataTestCase(APITestCase):
     def test_login_sets_session(self):
         self.client.post(self.url)
         assert Session.objects.first().get_decoded().get('email') == self.user.email
+
+    def test_logout_ends_session(self):
+        self.client.post(self.url)
+        assert self.client.delete('/api/user/').status_code == 204
+        assert self.client.get('/api/user/').status_code == 403
+
+
+class WaitListPositionTestCase(APITestCase):
+    def test_position_is_assigned_in_registration_order(self):
+        first = RegisteredUser.objects.create(email='first@email.com', referral_code='FIRST')
+        second = RegisteredUser.objects.create(email='second@email.com', referral_code='SECOND')
+        assert first.wait_list_position == 1
+        assert second.wait_list_position == 2
+        assert Sequence.next_value(Sequence.WAIT_LIST) == 3
+
+    def test_saving_user_does_not_move_them_in_the_queue(self):
+        first = RegisteredUser.objects.create(email='first@email.com', referral_code='FIRST')
+        RegisteredUser.objects.create(email='second@email.com', referral_code='SECOND')
+        first.referral_code = 'CHANGED'
+        first.save()
+        data = self.client.get('/api/user/CHANGED/').data
+        assert data['wait_list_position'] == 1
+
+    def test_rank_is_counted_until_the_ranking_is_loaded(self):
+        # never synced inside the test's transaction, like a join before the worker warmed up
+        RegisteredUser.objects.create(email='first@email.com', referral_code='FIRST')
+        Sequence.reserve(Sequence.WAIT_LIST, 1)
+        third = RegisteredUser.objects.create(email='third@email.com', referral_code='THIRD')
+        assert third.wait_list_position == 3
+        assert self.client.get('/api/user/THIRD/').data['wait_list_position'] == 2
+        RegisteredUser.objects.filter(pk=third.pk).update(referral_count=1)
+        with self.settings(WAIT_LIST_RANKING='referrals', WAIT_LIST_REFERRAL_BOOST=10):
+            assert ranking.wait_list_rank(3, 1) == 1
+            assert ranking.wait_list_rank(1, 0) == 2
+
+
+@override_settings(CACHES=LOCAL_CACHE, WAIT_LIST_RANK_SYNC_INTERVAL=0)
+class WaitListQueueTestCase(TransactionTestCase):
+    """
+    Positions shown in sign-up order have no gaps, whatever positions were handed out.
+    """
+    def setUp(self):
+        cache.clear()
+        patcher = mock.patch.object(ranking, 'ranking', ranking.Ranking())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        Sequence.set_value(Sequence.WAIT_LIST, 0)
+
+    def position(self, email):
+        return self.client.get('/api/user/detail/', {'email': email}).data['wait_list_position']
+
+    def test_failed_registration_leaves_no_gap(self):
+        RegisteredUser.objects.create(email='first@email.com', referral_code='FIRST')
+        self.client.post('/api/join/', {'email': 'first@email.com'})
+        self.client.post('/api/join/', {'email': 'second@email.com'})
+        assert self.position('second@email.com') == 2
+
+    @unittest.skipUnless(connection.vendor == 'postgresql', 'needs concurrent connections')
+    def test_registrations_commit_in_any_order_without_waiting(self):
+        registered, release = threading.Event(), threading.Event()
+
+        def register_and_wait():
+            try:
+                with transaction.atomic():
+                    RegisteredUser.objects.register('first@email.com')
+                    registered.set()
+                    release.wait(10)
+            finally:
+                connection.close()
+
+        first = threading.Thread(target=register_and_wait)
+        # distinct counter shards, which would otherwise be locked by the first registration one time in eight
+        with mock.patch('referrals.models.random.randrange', side_effect=[0, 1]):
+            first.start()
+            try:
+                assert registered.wait(10)
+                with transaction.atomic():
+                    with connection.cursor() as cursor:
+                        cursor.execute("SET LOCAL lock_timeout = '2s'")
+                    RegisteredUser.objects.register('second@email.com')
+                assert self.position('second@email.com') == 1
+            finally:
+                release.set()
+                first.join()
+        assert self.position('first@email.com') == 1
+        assert self.position('second@email.com') == 2
+
+
+class UserEndpointsQueryCountTestCase(APITestCase):
+    """
+    Statement counts exclude BEGIN/SAVEPOINT/RELEASE, which only some backends log.
+    """
+    TRANSACTION_CONTROL = ('BEGIN', 'SAVEPOINT', 'RELEASE SAVEPOINT', 'ROLLBACK')
+
+    def setUp(self):
+        self.user = RegisteredUser.objects.create(email='test@email.com', referral_code='TEST123')
+        RegisteredUser.objects.create(email='referred@email.com', referral_code='REF123', referred_by=self.user)
+        self.load_ranking()
+
+    @contextmanager
+    def assertNumStatements(self, num):
+        with CaptureQueriesContext(connection) as context:
+            yield
+        statements = [query['sql'] for query in context.captured_queries
+                      if not query['sql'].startswith(self.TRANSACTION_CONTROL)]
+        self.assertEqual(len(statements), num, '\n'.join(statements))
+
+    def test_retrieve(self):
+        # user, total_registered
+        with self.assertNumStatements(2):
+            data = self.client.get('/api/user/TEST123/').data
+        assert data['referral_count'] == 1
+        assert data['total_registered'] == 2
+        with self.assertNumStatements(0):
+            assert self.client.get('/api/user/TEST123/').data == data
+
+    def test_retrieve_detail(self):
+        with self.assertNumStatements(2):
+            self.client.get('/api/user/detail/', {'email': 'test@email.com'})
+        # cached under the code as well
+        with self.assertNumStatements(0):
+            self.client.get('/api/user/detail/', {'code': 'TEST123'})
+
+    def test_login(self):
+        # user, total_registered, session existence check, session insert
+        with self.assertNumStatements(4):
+            self.client.post('/api/user/TEST123/')
+
+    def test_logged_in_details(self):
+        self.client.post('/api/user/TEST123/')
+        # session
+        with self.assertNumStatements(1):
+            data = self.client.get('/api/user/').data
+        assert data['referral_count'] == 1
+
+    def test_register_new(self):
+        # PostgreSQL: wait-list position, upsert; elsewhere: position (update + read), insert,
+        # total_registered shard, total_registered read. Then outbox insert, session existence check and insert.
+        with self.assertNumStatements(5 if connection.vendor == 'postgresql' else 8):
+            self.client.post('/api/join/', {'email': 'valid@email.com'})
+
+    def test_register_from_referral(self):
+        # outside PostgreSQL, the referrer lookup, the referrer's update and the queued descendant are
+        # separate statements
+        with self.assertNumStatements(6 if connection.vendor == 'postgresql' else 12):
+            self.client.post('/api/join/TEST123/', {'email': 'valid@email.com'})
+
+
+@override_settings(METRICS_ALLOWED_IPS=['127.0.0.1'])
+class MetricsTestCase(APITestCase):
+    def setUp(self):
+        for metric in metrics.REQUEST_METRICS + metrics.EMAIL_METRICS:
+            metric.values.clear()
+        self.user = RegisteredUser.objects.create(email='test@email.com', referral_code='TEST123')
+        self.load_ranking()
+
+    def get_metrics(self):
+        response = self.client.get('/api/metrics/')
+        assert response['Content-Type'] == metrics.CONTENT_TYPE
+        worker = 'worker="{}",'.format(os.getpid())
+        return response.content.decode().replace(worker, '')
+
+    @override_settings(METRICS_SQL_SAMPLE_RATE=1)
+    def test_requests_are_recorded_per_route(self):
+        self.client.get('/api/user/TEST123/')
+        self.client.get('/api/user/TEST123/')
+        self.client.get('/api/user/UNKNOWN/')
+        text = self.get_metrics()
+        assert 'titan_http_request_duration_seconds_count{route="user-code",method="GET",status="200"} 2\n' in text
+        assert 'titan_http_request_duration_seconds_count{route="user-code",method="GET",status="404"} 1\n' in text
+        assert 'titan_http_request_duration_seconds_bucket{route="user-code",method="GET",status="200",le="+Inf"} 2\n' \
+            in text
+        # user and total_registered, then both cached, then the unknown user
+        assert 'titan_sql_statements_per_request_sum{route="user-code"} 3\n' in text
+        assert 'titan_sql_statements_per_request_bucket{route="user-code",le="0"} 1\n' in text
+
+    @override_settings(METRICS_SQL_SAMPLE_RATE=0)
+    def test_sql_is_only_timed_for_sampled_requests(self):
+        self.client.get('/api/user/TEST123/')
+        assert 'titan_sql_statements_per_request_count{' not in self.get_metrics()
+        assert 'make_cursor' not in connection.__dict__
+
+    def test_template_rendering_is_recorded(self):
+        self.client.post('/api/join/TEST123/', {'email': 'valid@email.com'})
+        text = self.get_metrics()
+        # welcome and referrer emails, text and html each
+        assert 'titan_template_renders_total{route="join-referral"} 4\n' in text
+        assert 'titan_template_render_seconds_total{route="join-referral"} ' in text
+
+    def test_only_allowed_addresses_and_staff_can_read_metrics(self):
+        with self.settings(METRICS_ALLOWED_IPS=[]):
+            assert self.client.get('/api/metrics/').status_code == 403
+            assert self.client.get('/api/metrics/', REMOTE_ADDR='10.0.0.9').status_code == 403
+            self.client.force_authenticate(User.objects.create_user('staff', password='secret', is_staff=True))
+            assert self.client.get('/api/metrics/').status_code == 200
+        self.client.force_authenticate(None)
+        assert self.client.get('/api/metrics/', REMOTE_ADDR='10.0.0.9').status_code == 403
+        assert self.client.get('/api/metrics/').status_code == 200
+
+    def test_unmatched_requests(self):
+        self.client.get('/nowhere/')
+        assert 'route="unmatched",method="GET",status="404"' in self.get_metrics()
+
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = metrics.Histogram('latency', 'Latency.', ('route',), buckets=(0.1, 1))
+        for value in (0.05, 0.5, 0.5, 2):
+            histogram.observe(('a',), value)
+        assert metrics.render([histogram]).splitlines() == [
+            '# HELP latency Latency.',
+            '# TYPE latency histogram',
+            'latency_bucket{route="a",le="0.1"} 1',
+            'latency_bucket{route="a",le="1"} 3',
+            'latency_bucket{route="a",le="+Inf"} 4',
+            'latency_count{route="a"} 4',
+            'latency_sum{route="a"} 3.05',
+        ]
+
+    def test_send_outbox_writes_email_metrics(self):
+        OutboundEmail.enqueue('Subject', 'Message', '', 'valid@email.com')
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'outbox.prom')
+        call_command('send_outbox', '--once', '--metrics-file', path, stdout=StringIO())
+        with open(path) as metrics_file:
+            text = metrics_file.read()
+        assert 'titan_emails_sent_total{result="sent"} 1\n' in text
+        assert 'titan_email_send_seconds_count 1\n' in text
+
+
+class UserCacheTestCase(APITestCase):
+    def setUp(self):
+        self.user = RegisteredUser.objects.create(email='test@email.com', referral_code='TEST123')
+        shared_cache.user_cache_stats.clear()
+
+    def test_hits_and_misses_are_counted(self):
+        self.client.get('/api/user/TEST123/')
+        self.client.get('/api/user/detail/', {'email': 'test@email.com'})
+        assert shared_cache.user_cache_stats == {'misses': 1, 'hits': 1}
+
+    def test_referral_invalidates_referrer(self):
+        assert self.client.get('/api/user/TEST123/').data['referral_count'] == 0
+        self.client.post('/api/join/TEST123/', {'email': 'valid@email.com'})
+        assert shared_cache.user_cache_stats['invalidations'] == 1
+        assert cache.get(shared_cache.user_key('referral_code', 'TEST123')) == shared_cache.CHANGED
+        assert self.client.get('/api/user/TEST123/').data['referral_count'] == 1
+        assert self.client.get('/api/user/detail/', {'email': 'test@email.com'}).data['referral_count'] == 1
+
+    def test_payload_read_before_a_change_does_not_replace_the_invalidation(self):
+        def read_then_change(queryset, **lookup):
+            user = get_object_or_404(queryset, **lookup)
+            RegisteredUser.objects.filter(pk=user.pk).update(referral_count=1)
+            shared_cache.invalidate_user(user)
+            return user
+
+        with mock.patch('referrals.views.get_object_or_404', side_effect=read_then_change):
+            assert self.client.get('/api/user/TEST123/').data['referral_count'] == 0
+        assert cache.get(shared_cache.user_key('referral_code', 'TEST123')) == shared_cache.CHANGED
+        assert cache.get(shared_cache.user_key('email', 'test@email.com')) == shared_cache.CHANGED
+        assert self.client.get('/api/user/TEST123/').data['referral_count'] == 1
+
+    def test_total_registered_is_merged_into_cached_payloads(self):
+        cache.set('referrals:total_registered', (42, time.time() + 60), 60)
+        self.client.get('/api/user/TEST123/')
+        cache.set('referrals:total_registered', (43, time.time() + 60), 60)
+        data = self.client.get('/api/user/TEST123/').data
+        assert data['total_registered'] == 43
+        assert cache.get(shared_cache.user_key('referral_code', 'TEST123'))['referral_count'] == 0
+
+    def test_reconcile_invalidates_fixed_users(self):
+        RegisteredUser.objects.create(email='referred@email.com', referred_by=self.user)
+        RegisteredUser.objects.filter(pk=self.user.pk).update(referral_count=5)
+        assert self.client.get('/api/user/TEST123/').data['referral_count'] == 5
+        call_command('reconcile_counters', stdout=StringIO())
+        assert self.client.get('/api/user/TEST123/').data['referral_count'] == 1
+
+
+class ReferralTreeTestCase(APITestCase):
+    def setUp(self):
+        self.root = RegisteredUser.objects.create(email='root@email.com', referral_code='ROOT')
+
+    def join(self, code, email):
+        return self.client.post('/api/join/{}/'.format(code), {'email': email}).data
+
+    def test_depth_and_descendants_are_maintained_on_join(self):
+        child = self.join('ROOT', 'child@email.com')
+        grandchild = self.join(child['referral_code'], 'grandchild@email.com')
+        self.join(child['referral_code'], 'sibling@email.com')
+        assert (child['depth'], grandchild['depth']) == (1, 2)
+        assert flush_descendant_counts() == 3
+
+        root = self.client.get('/api/user/ROOT/').data
+        assert (root['depth'], root['descendant_count'], root['referral_count']) == (0, 3, 1)
+        child = self.client.get('/api/user/{}/'.format(child['referral_code'])).data
+        assert (child['descendant_count'], child['referral_count']) == (2, 2)
+        assert RegisteredUser.objects.get(email='grandchild@email.com').ancestor_ids() == \
+            [self.root.id, RegisteredUser.objects.get(email='child@email.com').id]
+
+    def test_descendants_are_counted_in_batches(self):
+        child = self.join('ROOT', 'child@email.com')
+        self.join(child['referral_code'], 'grandchild@email.com')
+        self.join(child['referral_code'], 'sibling@email.com')
+        assert self.client.get('/api/user/ROOT/').data['descendant_count'] == 0
+        assert flush_descendant_counts(batch_size=2) == 2
+        assert self.client.get('/api/user/ROOT/').data['descendant_count'] == 2
+        assert flush_descendant_counts() == 1
+        assert self.client.get('/api/user/ROOT/').data['descendant_count'] == 3
+        assert self.client.get('/api/user/{}/'.format(child['referral_code'])).data['descendant_count'] == 2
+        assert not PendingDescendant.objects.exists()
+
+    def test_count_descendants_command(self):
+        self.join('ROOT', 'child@email.com')
+        call_command('count_descendants', '--once', stdout=StringIO())
+        assert RegisteredUser.objects.get(pk=self.root.pk).descendant_count == 1
+
+
+class ImportRegistrationsTestCase(APITestCase):
+    def setUp(self):
+        self.referrer = RegisteredUser.objects.create(email='referrer@email.com', referral_code='REF')
+        self.child = RegisteredUser.objects.create(email='child@email.com', referral_code='CHILD',
+                                                   referred_by=self.referrer)
+
+    def run_import(self, content, *args):
+        with tempfile.NamedTemporaryFile('w', suffix='.csv') as csv_file:
+            csv_file.write(content)
+            csv_file.flush()
+            out = StringIO()
+            call_command('import_registrations', csv_file.name, '--batch-size', '2', *args, stdout=out)
+        return out.getvalue()
+
+    def test_users_are_registered_in_file_order(self):
+        out = self.run_import('email\nfirst@email.com\n second@email.com \nthird@email.com\n')
+        assert 'Imported 3 users' in out
+        users = list(RegisteredUser.objects.order_by('wait_list_position')[2:])
+        assert [(user.email, user.wait_list_position) for user in users] == \
+            [('first@email.com', 3), ('second@email.com', 4), ('third@email.com', 5)]
+        assert all(user.referral_code == referral_code_for(user.wait_list_position) for user in users)
+        assert CounterShard.get_value(CounterShard.TOTAL_REGISTERED) == 5
+        assert Sequence.next_value(Sequence.WAIT_LIST) == 6
+
+    def test_invalid_duplicate_and_unknown_referrer_rows_are_skipped(self):
+        out = self.run_import('email,referrer_code\nnot-an-email,\nchild@email.com,\nnew@email.com,\n'
+                              'new@email.com,\nother@email.com,NOPE\n')
+        assert 'Imported 1 users, skipped 2 duplicate, 1 invalid and 1 with an unknown referrer' in out
+        assert RegisteredUser.objects.count() == 3
+
+    def test_referrers_are_credited(self):
+        self.run_import('email,referrer_code\na@email.com,CHILD\nb@email.com,CHILD\nc@email.com,REF\n')
+        # CHILD itself joined the usual way
+        flush_descendant_counts()
+        self.referrer.refresh_from_db()
+        self.child.refresh_from_db()
+        assert (self.referrer.referral_count, self.referrer.descendant_count) == (2, 4)
+        assert (self.child.referral_count, self.child.descendant_count) == (2, 2)
+        imported = RegisteredUser.objects.get(email='a@email.com')
+        assert (imported.depth, imported.ancestor_ids()) == (2, [self.referrer.id, self.child.id])
+
+    def test_clashing_legacy_code_is_skipped(self):
+        RegisteredUser.objects.create(email='legacy@email.com', referral_code=referral_code_for(4))
+        self.run_import('email\nnew@email.com\n')
+        assert RegisteredUser.objects.get(email='new@email.com').referral_code == referral_code_for(4, 1)
+
+    def test_emails_are_only_queued_on_request(self):
+        self.run_import('email,referrer_code\na@email.com,REF\nb@email.com,REF\n')
+        assert not OutboundEmail.objects.exists()
+        self.run_import('email,referrer_code\nc@email.com,REF\nd@email.com,REF\n', '--notify', 'http://titan/')
+        assert sorted(OutboundEmail.objects.values_list('recipient', flat=True)) == \
+            ['c@email.com', 'd@email.com', 'referrer@email.com']
+
+    @override_settings(REFERRER_DIGEST_WINDOW=600)
+    def test_referrers_are_notified_through_digests(self):
+        self.run_import('email,referrer_code\na@email.com,REF\nb@email.com,REF\nc@email.com,REF\n',
+                        '--notify', 'http://titan/')
+        assert ReferrerDigest.objects.get(referrer=self.referrer).referrals == 3
+        assert not OutboundEmail.objects.filter(recipient='referrer@email.com').exists()
+
+    def test_emails_registered_during_the_batch_are_skipped(self):
+        # racer@ joins on the web after the batch looked up which of its emails are registered
+        RegisteredUser.objects.create(email='racer@email.com', referral_code='RACER')
+        with mock.patch.object(import_registrations, 'registered_emails',
+                               side_effect=[set(), {'racer@email.com'}]):
+            out = self.run_import('email\nnew@email.com\nracer@email.com\n')
+        assert 'Imported 1 users, skipped 1 duplicate' in out
+        assert RegisteredUser.objects.get(email='racer@email.com').referral_code == 'RACER'
+        assert RegisteredUser.objects.filter(email='new@email.com').exists()
+        assert CounterShard.get_value(CounterShard.TOTAL_REGISTERED) == 4
+
+
+class ExportTestCase(APITestCase):
+    def setUp(self):
+        self.referrer = RegisteredUser.objects.create(email='referrer@email.com', referral_code='REF')
+        RegisteredUser.objects.create(email='child@email.com', referral_code='CHILD', referred_by=self.referrer)
+        flush_descendant_counts()
+        self.staff = User.objects.create_user('staff', password='secret', is_staff=True)
+        self.load_ranking()
+
+    def get(self, **params):
+        response = self.client.get('/api/export/', params)
+        return response, b''.join(response.streaming_content).decode()
+
+    def test_staff_only(self):
+        assert self.client.get('/api/export/').status_code == 403
+        self.client.force_authenticate(User.objects.create_user('user', password='secret'))
+        assert self.client.get('/api/export/').status_code == 403
+
+    def test_csv(self):
+        self.client.force_authenticate(self.staff)
+        with self.assertNumQueries(1):
+            response, content = self.get()
+        assert response['Content-Type'] == 'text/csv'
+        lines = content.splitlines()
+        assert lines[0].startswith('email,referral_code,referred_by,referral_count,wait_list_position')
+        assert lines[1].startswith('referrer@email.com,REF,,1,1,0,1,')
+        assert lines[2].startswith('child@email.com,CHILD,REF,0,2,1,0,')
+
+    def test_ndjson(self):
+        self.client.force_authenticate(self.staff)
+        response, content = self.get(output='ndjson')
+        users = [json.loads(line) for line in content.splitlines()]
+        assert [(user['email'], user['referred_by'], user['referral_count']) for user in users] == \
+            [('referrer@email.com', None, 1), ('child@email.com', 'REF', 0)]
+        assert self.client.get('/api/export/', {'output': 'xml'}).status_code == 400
+
+    def test_command(self):
+        out = StringIO()
+        call_command('export_waitlist', '--format', 'ndjson', stdout=out)
+        assert [json.loads(line)['email'] for line in out.getvalue().splitlines()] == \
+            ['referrer@email.com', 'child@email.com']
+
+
+@override_settings(DATABASE_REPLICAS=['replica'])
+class PrimaryReplicaRouterTestCase(SimpleTestCase):
+    def setUp(self):
+        self.router = routers.PrimaryReplicaRouter()
+        self.middleware = routers.ReplicaPinningMiddleware()
+        self.addCleanup(routers.state.__dict__.clear)
+
+    def test_reads_go_to_replicas_and_writes_to_primary(self):
+        assert self.router.db_for_read(RegisteredUser) == 'replica'
+        assert self.router.db_for_write(RegisteredUser) == DEFAULT_DB_ALIAS
+        with override_settings(DATABASE_REPLICAS=[]):
+            assert self.router.db_for_read(RegisteredUser) == DEFAULT_DB_ALIAS
+
+    def test_writing_pins_the_client_to_the_primary(self):
+        request = RequestFactory().post('/api/join/')
+        self.middleware.process_request(request)
+        assert self.router.db_for_read(RegisteredUser) == DEFAULT_DB_ALIAS
+        self.router.db_for_write(RegisteredUser)
+        response = self.middleware.process_response(request, HttpResponse())
+        assert self.router.db_for_read(RegisteredUser) == 'replica'
+
+        request = RequestFactory().get('/api/user/')
+        request.COOKIES[routers.PIN_COOKIE] = response.cookies[routers.PIN_COOKIE].value
+        self.middleware.process_request(request)
+        assert self.router.db_for_read(RegisteredUser) == DEFAULT_DB_ALIAS
+        assert routers.PIN_COOKIE not in self.middleware.process_response(request, HttpResponse()).cookies
+
+    def test_pin_expires(self):
+        request = RequestFactory().get('/api/user/')
+        request.COOKIES[routers.PIN_COOKIE] = str(time.time() - 1)
+        self.middleware.process_request(request)
+        assert self.router.db_for_read(RegisteredUser) == 'replica'
+
+
+@unittest.skipUnless('replica' in settings.DATABASES, 'needs a replica database (TEST MIRROR of default)')
+@override_settings(DATABASE_REPLICAS=['replica'], CACHES=LOCAL_CACHE)
+class ReplicaReadsTestCase(TransactionTestCase):
+    multi_db = True
+
+    def setUp(self):
+        cache.clear()
+
+    def reads_from(self, alias, request):
+        with CaptureQueriesContext(connections[alias]) as context:
+            response = request()
+        return response, len(context.captured_queries)
+
+    def test_client_reads_its_own_writes_from_the_primary(self):
+        self.client.post('/api/join/', {'email': 'valid@email.com'})
+        code = RegisteredUser.objects.get().referral_code
+        response, queries = self.reads_from(DEFAULT_DB_ALIAS, lambda: self.client.get('/api/user/'))
+        assert response.status_code == 200
+        assert queries > 0
+
+        cache.clear()
+        _, queries = self.reads_from('replica', lambda: Client().get('/api/user/{}/'.format(code)))
+        assert queries > 0
+
+
+@override_settings(SESSION_MODE='token', SESSION_TOKEN_KEYS=['current-key'])
+class SessionTokenTestCase(APITestCase):
+    def setUp(self):
+        self.user = RegisteredUser.objects.create(email='test@email.com', referral_code='TEST123')
+        self.load_ranking()
+
+    def test_login_issues_a_token_instead_of_a_session(self):
+        response = self.client.post('/api/join/', {'email': 'valid@email.com'})
+        assert response[sessions.TOKEN_HEADER] == self.client.cookies['titan_token'].value
+        assert not Session.objects.exists()
+        with self.assertNumQueries(2):
+            data = self.client.get('/api/user/').data
+        assert data['email'] == 'valid@email.com'
+        # the user by primary key only
+        with self.assertNumQueries(1):
+            self.client.get('/api/user/')
+
+    def test_bearer_token(self):
+        token = self.client.post('/api/user/TEST123/')[sessions.TOKEN_HEADER]
+        client = test.APIClient(HTTP_AUTHORIZATION='Bearer ' + token)
+        assert client.get('/api/user/').data['email'] == 'test@email.com'
+        assert test.APIClient(HTTP_AUTHORIZATION='Bearer ' + token[:-1]).get('/api/user/').status_code == 403
+
+    def test_logout_revokes_every_token(self):
+        token = self.client.post('/api/user/TEST123/')[sessions.TOKEN_HEADER]
+        other = test.APIClient(HTTP_AUTHORIZATION='Bearer ' + token)
+        assert self.client.delete('/api/user/').status_code == 204
+        assert other.get('/api/user/').status_code == 403
+        assert self.client.get('/api/user/').status_code == 403
+
+    def test_expired_token_is_rejected(self):
+        self.client.post('/api/user/TEST123/')
+        with self.settings(SESSION_TOKEN_MAX_AGE=-1):
+            assert self.client.get('/api/user/').status_code == 403
+
+    def test_tokens_are_rotated(self):
+        with self.settings(SESSION_TOKEN_KEYS=['old-key']):
+            old = self.client.post('/api/user/TEST123/')[sessions.TOKEN_HEADER]
+        with self.settings(SESSION_TOKEN_KEYS=['current-key', 'old-key']):
+            response = self.client.get('/api/user/')
+        assert response.status_code == 200
+        assert response[sessions.TOKEN_HEADER] != old
+        assert self.client.get('/api/user/').status_code == 200
+        assert sessions.TOKEN_HEADER not in self.client.get('/api/user/')
+
+    def test_database_sessions_are_migrated(self):
+        with self.settings(SESSION_MODE='database'):
+            self.client.post('/api/user/TEST123/')
+        assert Session.objects.count() == 1
+        response = self.client.get('/api/user/')
+        assert response.data['email'] == 'test@email.com'
+        assert sessions.TOKEN_HEADER in response
+        assert not Session.objects.exists()
+        assert self.client.get('/api/user/').status_code == 200
+
+
+class LeaderboardTestCase(APITestCase):
+    def setUp(self):
+        for name, referral_count in (('a', 1), ('b', 3), ('c', 0), ('d', 1), ('e', 2)):
+            RegisteredUser.objects.create(email=name + '@email.com', referral_code=name.upper(),
+                                          referral_count=referral_count)
+
+    def pages(self, limit=2):
+        response = self.client.get('/api/leaderboard/', {'limit': limit})
+        yield response.data
+        while response.data['next']:
+            response = self.client.get('/api/leaderboard/', {'limit': limit, 'cursor': response.data['next']})
+            yield response.data
+
+    def test_top_referrers_in_order(self):
+        entries = [entry for page in self.pages() for entry in page['results']]
+        assert [(entry['name'], entry['referral_count'], entry['rank']) for entry in entries] == \
+            [('b***@e***.com', 3, 1), ('e***@e***.com', 2, 2), ('a***@e***.com', 1, 3), ('d***@e***.com', 1, 4)]
+
+    def test_referral_codes_and_emails_are_not_published(self):
+        RegisteredUser.objects.create(email='top@secret.com', referral_code='TOPREF12', referral_count=9)
+        content = self.client.get('/api/leaderboard/').content.decode()
+        assert 'TOPREF12' not in content and 'top@secret.com' not in content
+        assert json.loads(content)['results'][0] == {'name': 't***@s***.com', 'referral_count': 9, 'rank': 1}
+
+    def test_emails_are_masked(self):
+        assert leaderboard.mask_email('jane.doe@example.co.uk') == 'j***@e***.uk'
+        assert leaderboard.mask_email('root@localhost') == 'r***@l***'
+
+    def test_pages_come_from_one_snapshot(self):
+        pages = self.pages()
+        assert [entry['rank'] for entry in next(pages)['results']] == [1, 2]
+        RegisteredUser.objects.filter(referral_code='D').update(referral_count=10)
+        cache.delete(leaderboard.CURRENT_KEY)
+        with self.assertNumQueries(0):
+            assert [entry['name'] for entry in next(pages)['results']] == ['a***@e***.com', 'd***@e***.com']
+
+    def test_expired_snapshot_continues_from_the_table(self):
+        pages = self.pages()
+        first = next(pages)
+        cache.clear()
+        second = self.client.get('/api/leaderboard/', {'limit': 2, 'cursor': first['next']}).data
+        assert [(entry['name'], entry['rank']) for entry in second['results']] == \
+            [('a***@e***.com', 3), ('d***@e***.com', 4)]
+        assert second['next'] is None
+
+    def test_snapshot_size_is_not_a_limit(self):
+        with self.settings(LEADERBOARD_SIZE=2):
+            entries = [entry for page in self.pages(limit=1) for entry in page['results']]
+        assert [entry['name'][0] for entry in entries] == ['b', 'e', 'a', 'd']
+
+    def test_invalid_parameters_return_400(self):
+        assert self.client.get('/api/leaderboard/', {'cursor': 'nonsense'}).status_code == 400
+        assert self.client.get('/api/leaderboard/', {'limit': 0}).status_code == 400
+
+
+class RankIndexTestCase(unittest.TestCase):
+    def expected_rank(self, counts, boost, position):
+        key = (position - boost * counts[position], position)
+        return 1 + sum((other - boost * count, other) < key for other, count in counts.items())
+
+    def test_matches_a_full_sort_under_random_updates(self):
+        rng = random.Random(4)
+        counts = {position: 0 for position in range(1, 200)}
+        index = ranking.RankIndex(3, list(counts), list(counts.values()))
+        for _ in range(2000):
+            position = rng.randrange(1, 260)
+            counts[position] = counts.get(position, -1) + 1 if rng.random() < 0.9 else rng.randrange(80)
+            index.set(position, counts[position])
+        assert len(index) == len(counts)
+        for position in counts:
+            assert index.rank(position, counts[position]) == self.expected_rank(counts, 3, position)
+
+    def test_rank_of_a_user_not_indexed_yet(self):
+        index = ranking.RankIndex(10, [1, 2, 3], [0, 0, 1])
+        assert index.rank(4, 0) == 4
+        assert index.rank(10 ** 6, 0) == 4
+        assert index.rank(4, 1) == 2
+
+
+@override_settings(CACHES=LOCAL_CACHE, WAIT_LIST_RANKING='referrals', WAIT_LIST_REFERRAL_BOOST=2,
+                   WAIT_LIST_RANK_SYNC_INTERVAL=0)
+class ReferralRankingTestCase(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        patcher = mock.patch.object(ranking, 'ranking', ranking.Ranking())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        for name in ('first', 'second', 'third'):
+            RegisteredUser.objects.create(email=name + '@email.com', referral_code=name.upper())
+
+    def position(self, code):
+        return self.client.get('/api/user/{}/'.format(code)).data['wait_list_position']
+
+    def test_referrals_move_users_up(self):
+        assert self.position('THIRD') == 3
+        self.client.post('/api/join/THIRD/', {'email': 'fourth@email.com'})
+        self.client.post('/api/join/THIRD/', {'email': 'fifth@email.com'})
+        assert self.position('THIRD') == 1
+        assert self.position('FIRST') == 2
+        assert self.position('SECOND') == 3
+
+    def test_reconcile_reloads_ranking(self):
+        RegisteredUser.objects.create(email='fourth@email.com',
+                                      referred_by=RegisteredUser.objects.get(referral_code='SECOND'))
+        RegisteredUser.objects.filter(referral_code='SECOND').update(referral_count=0)
+        assert self.position('FIRST') == 1
+        call_command('reconcile_counters', stdout=StringIO())
+        assert self.position('FIRST') == 2
+
+
+@unittest.skipUnless(connection.vendor == 'postgresql', 'needs concurrent connections')
+@override_settings(CACHES=LOCAL_CACHE, WAIT_LIST_RANK_SYNC_INTERVAL=0)
+class ConcurrentJoinTestCase(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        patcher = mock.patch.object(ranking, 'ranking', ranking.Ranking())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def join(self, url):
+        try:
+            return Client().post(url, {'email': 'valid@email.com'}).status_code
+        finally:
+            connection.close()
+
+    def assert_single_registration(self, url):
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            statuses = sorted(executor.map(self.join, [url] * 16))
+        assert statuses == [200] + [400] * 15
+        assert RegisteredUser.objects.filter(email='valid@email.com').count() == 1
+
+    def test_parallel_joins_register_email_once(self):
+        self.assert_single_registration('/api/join/')
+        assert self.client.get('/api/user/detail/', {'email': 'valid@email.com'}).data['wait_list_position'] == 1
+
+    def test_parallel_referred_joins_credit_referrer_once(self):
+        referrer = RegisteredUser.objects.create(email='test@email.com', referral_code='TEST123')
+        self.assert_single_registration('/api/join/TEST123/')
+        referrer.refresh_from_db()
+        assert referrer.referral_count == 1
+
+    def test_reconcile_keeps_joins_committing_meanwhile(self):
+        # as created by the migrations, which the flush between these tests drops
+        CounterShard.objects.bulk_create(CounterShard(name=CounterShard.TOTAL_REGISTERED, shard=shard)
+                                         for shard in range(getattr(settings, 'COUNTER_SHARDS', 8)))
+        CounterShard.set_value(CounterShard.TOTAL_REGISTERED, 5)
+        registered, release = threading.Event(), threading.Event()
+
+        def register_and_wait():
+            try:
+                with transaction.atomic():
+                    RegisteredUser.objects.register('first@email.com')
+                    registered.set()
+                    release.wait(10)
+            finally:
+                connection.close()
+
+        def reconcile():
+            try:
+                call_command('reconcile_counters', stdout=StringIO())
+            finally:
+                connection.close()
+
+        join = threading.Thread(target=register_and_wait)
+        join.start()
+        assert registered.wait(10)
+        reconciling = threading.Thread(target=reconcile)
+        reconciling.start()
+        # let reconcile_counters reach the shard the join holds
+        time.sleep(0.5)
+        release.set()
+        join.join()
+        reconciling.join()
+        assert CounterShard.get_value(CounterShard.TOTAL_REGISTERED) == 1
+
+
+class CountersTestCase(APITestCase):
+    def setUp(self):
+        self.user = RegisteredUser.objects.create(email='test@email.com', referral_code='TEST123')
+
+    def test_registration_updates_counters(self):
+        self.client.post('/api/join/', {'email': 'first@email.com'})
+        self.client.post('/api/join/TEST123/', {'email': 'second@email.com'})
+        self.user.refresh_from_db()
+        assert self.user.referral_count == 1
+        assert CounterShard.get_value(CounterShard.TOTAL_REGISTERED) == 3
+
+    def test_failed_registration_does_not_update_counters(self):
+        self.client.post('/api/join/TEST123/', {'email': 'test@email.com'})
+        self.user.refresh_from_db()
+        assert self.user.referral_count == 0
+        assert CounterShard.get_value(CounterShard.TOTAL_REGISTERED) == 1
+
+    def test_reconcile_fixes_drift(self):
+        RegisteredUser.objects.create(email='referred@email.com', referral_code='REF123', referred_by=self.user)
+        RegisteredUser.objects.filter(pk=self.user.pk).update(referral_count=5)
+        CounterShard.set_value(CounterShard.TOTAL_REGISTERED, 10)
+
+        call_command('reconcile_counters', '--dry-run', stdout=StringIO())
+        self.user.refresh_from_db()
+        assert self.user.referral_count == 5
+
+        call_command('reconcile_counters', stdout=StringIO())
+        self.user.refresh_from_db()
+        assert self.user.referral_count == 1
+        assert CounterShard.get_value(CounterShard.TOTAL_REGISTERED) == 2
+
+
+class ReferralCodeTestCase(APITestCase):
+    def test_permutation_is_injective(self):
+        key = b'test-key'
+        numbers = list(range(10000)) + list(range(DOMAIN - 10000, DOMAIN))
+        permuted = {permute(number, key) for number in numbers}
+        assert len(permuted) == len(numbers)
+        assert all(0 <= number < DOMAIN for number in permuted)
+
+    def test_codes_have_fixed_length(self):
+        assert encode(0) == 'AAAAAAAA'
+        assert encode(DOMAIN - 1) == '99999999'
+
+    def test_code_is_derived_from_wait_list_position(self):
+        user = RegisteredUser.objects.create(email='test@email.com')
+        assert user.referral_code == referral_code_for(user.wait_list_position)
+
+    def test_code_clashing_with_legacy_code_is_skipped(self):
+        legacy_code = referral_code_for(2)
+        RegisteredUser.objects.create(email='legacy@email.com', referral_code=legacy_code)
+        response = self.client.post('/api/join/', {'email': 'valid@email.com'})
+        assert response.status_code == 200
+        assert response.data['referral_code'] == referral_code_for(2, attempt=1)
+
+    def test_join_fails_when_position_is_taken(self):
+        RegisteredUser.objects.create(email='taken@email.com', referral_code='TAKEN', wait_list_position=1)
+        response = self.client.post('/api/join/', {'email': 'valid@email.com'})
+        assert response.status_code == 400
+        assert RegisteredUser.objects.count() == 1
+
+    def test_clashing_codes_are_tried_a_few_times_only(self):
+        RegisteredUser.objects.create(email='legacy@email.com', referral_code='LEGACY')
+        with mock.patch('referrals.models.referral_code_for', return_value='LEGACY') as code_for:
+            response = self.client.post('/api/join/', {'email': 'valid@email.com'})
+        assert response.status_code == 400
+        assert code_for.call_count == MAX_ATTEMPTS
+
+
+class EmailOutboxTestCase(APITestCase):
+    def setUp(self):
+        self.user = RegisteredUser.objects.create(email='test@email.com', referral_code='TEST123')
+
+    def test_registration_queues_emails_instead_of_sending(self):
+        self.client.post('/api/join/TEST123/', {'email': 'valid@email.com'})
+        assert len(mail.outbox) == 0
+        assert sorted(OutboundEmail.objects.values_list('recipient', flat=True)) == ['test@email.com',
+                                                                                      'valid@email.com']
+
+    def test_failed_registration_queues_nothing(self):
+        self.client.post('/api/join/TEST123/', {'email': 'test@email.com'})
+        assert OutboundEmail.objects.count() == 0
+
+    def test_send_batch_sends_due_emails(self):
+        self.client.post('/api/join/', {'email': 'valid@email.com'})
+        assert send_batch() == 1
+        assert len(mail.outbox) == 1
+        assert mail.outbox[0].to == ['valid@email.com']
+        assert mail.outbox[0].alternatives[0][1] == 'text/html'
+        assert OutboundEmail.objects.get().sent_at is not None
+        assert send_batch() == 0
+
+    def test_failed_email_is_retried_later(self):
+        OutboundEmail.enqueue('Subject', 'Message', '', 'valid@email.com')
+        with mock.patch('django.core.mail.backends.locmem.EmailBackend.send_messages', side_effect=OSError):
+            assert send_batch() == 1
+        email = OutboundEmail.objects.get()
+        assert email.sent_at is None
+        assert email.attempts == 1
+        assert email.next_attempt_at > timezone.now()
+        assert send_batch() == 0
+
+    def test_send_outbox_command_drains_outbox(self):
+        for i in range(3):
+            OutboundEmail.enqueue('Subject', 'Message', '', 'user{}@email.com'.format(i))
+        call_command('send_outbox', '--once', '--batch-size', '2', stdout=StringIO())
+        assert len(mail.outbox) == 3
+
+
+@override_settings(REFERRER_DIGEST_WINDOW=600)
+class ReferrerDigestTestCase(APITestCase):
+    def setUp(self):
+        self.user = RegisteredUser.objects.create(email='test@email.com', referral_code='TEST123')
+
+    def join(self, count):
+        for i in range(count):
+            self.client.post('/api/join/TEST123/', {'email': 'user{}@email.com'.format(i)})
+
+    def test_referrals_are_buffered_per_referrer(self):
+        self.join(3)
+        assert ReferrerDigest.objects.get(referrer=self.user).referrals == 3
+        assert not OutboundEmail.objects.filter(recipient='test@email.com').exists()
+
+    def test_digest_is_not_sent_before_window_passes(self):
+        self.join(1)
+        assert flush_referrer_digests() == 0
+
+    def test_digest_is_sent_once_with_aggregated_count(self):
+        self.join(3)
+        ReferrerDigest.objects.update(first_referral_at=timezone.now() - timedelta(seconds=601))
+        assert flush_referrer_digests() == 1
+        email = OutboundEmail.objects.get(recipient='test@email.com')
+        assert '3 of your friends signed up' in email.message
+        assert ReferrerDigest.objects.count() == 0
+
+    @override_settings(REFERRER_DIGEST_WINDOW=0)
+    def test_referrer_is_notified_per_referral_without_window(self):
+        self.join(2)
+        assert OutboundEmail.objects.filter(recipient='test@email.com').count() == 2
+        assert ReferrerDigest.objects.count() == 0
+
+
+CHART_CSV = """Date,01/02/2015,01/05/2015,01/06/2015
+Titan,100,101.5,99.25
+S&P 500,100,98.5,97
+"""
+
+class ChartFilesMixin(object):
+    def setUp(self):
+        cache.clear()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.chart_path = self.write('chart.csv', CHART_CSV)
+        settings_override = override_settings(PATH_TO_CSV_CHART=self.chart_path, CHART_RELOAD_INTERVAL=0)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        charts.charts.files.clear()
+
+    def write(self, name, content):
+        path = os.path.join(self.directory, name)
+        with open(path, 'w') as csv_file:
+            csv_file.write(content)
+        return path
+
+
+class ChartDataTestCase(ChartFilesMixin, APITestCase):
+    def test_chart_is_returned_for_period(self):
+        response = self.client.get('/api/chart/', {'period': '1y'})
+        assert response.status_code == 200
+        assert json.loads(response.content.decode()) == {
+            'labels': [1420156800, 1420416000, 1420502400],
+            'titan': [100, 101.5, 99.25],
+            'sp500': [100, 98.5, 97],
+        }
+
+    def test_invalid_period_returns_400(self):
+        response = self.client.get('/api/chart/', {'period': '2y'})
+        assert response.status_code == 400
+
+    def test_stats_are_computed_from_chart(self):
+        response = self.client.get('/api/stats/')
+        stats = {row['label']: (row['titan'], row['sp500']) for row in json.loads(response.content.decode())}
+        assert list(stats) == list(charts.STAT_LABELS)
+        assert stats['Total return'] == (-0.75, -3)
+        assert stats['Max drawdown'] == (-2.22, -3)
+        # all in January
+        assert stats['Best month'] == stats['Worst month'] == (-0.75, -3)
+
+    def test_stats_of_a_single_point_are_empty(self):
+        response = self.client.get('/api/stats/', {'from': 1420416000, 'to': 1420416000})
+        assert all(row['titan'] is None and row['sp500'] is None for row in json.loads(response.content.decode()))
+
+    def test_stats_invalid_range_returns_400(self):
+        assert self.client.get('/api/stats/', {'period': '2y'}).status_code == 400
+        assert self.client.get('/api/stats/', {'from': 2, 'to': 1}).status_code == 400
+
+    def test_stats_are_computed_once_per_range(self):
+        with mock.patch('referrals.charts.performance', wraps=charts.performance) as performance:
+            charts.stats_payload('1Y').body
+            charts.stats_payload('1Y').body
+            charts.stats_payload(start=1420416000).body
+        assert performance.call_count == 2
+
+    def test_annualized_stats(self):
+        year = int(charts.YEAR)
+        chart = charts.Chart(np.array([0, year, 2 * year]), np.array([100, 110, 121.0]), np.array([100, 90, 99.0]))
+        stats = {row['label']: (row['titan'], row['sp500']) for row in chart.stats(0, 3)}
+        assert stats['Total return'] == (21, -1)
+        assert stats['Annualized return'] == (10, -0.5)
+        assert stats['Max drawdown'] == (0, -10)
+        assert stats['Best month'] == (10, 10)
+        assert stats['Worst month'] == (10, -10)
+        # no volatility, no Sharpe ratio
+        assert stats['Volatility'][0] == 0
+        assert stats['Sharpe ratio'][0] is None
+        assert stats['Volatility'][1] == 14.14
+        assert stats['Sharpe ratio'][1] == 0
+
+    def test_file_is_parsed_once(self):
+        with mock.patch.object(charts.charts, 'read', wraps=charts.charts.read) as read:
+            first = charts.chart_payload('ALL').body
+            second = charts.chart_payload('ALL').body
+        assert first is second
+        assert read.call_count == 1
+
+    def test_file_is_reloaded_when_it_changes(self):
+        charts.chart_payload('ALL').body
+        self.write('chart.csv', CHART_CSV.replace('99.25', '98'))
+        os.utime(self.chart_path, ns=(0, 0))
+        assert json.loads(charts.chart_payload('ALL').body.decode())['titan'][-1] == 98
+
+    def test_response_has_validators(self):
+        response = self.client.get('/api/chart/')
+        assert response['ETag'].startswith('"')
+        assert response['Last-Modified']
+        assert 'Accept-Encoding' in response['Vary']
+
+    def test_unchanged_chart_returns_304_without_io_or_serialization(self):
+        etag = self.client.get('/api/chart/', {'period': '1y'})['ETag']
+        with self.settings(CHART_RELOAD_INTERVAL=60), \
+                mock.patch('referrals.charts.os') as os_module, \
+                mock.patch('referrals.charts.open', create=True) as open_file, \
+                mock.patch('referrals.charts.dump_json') as dump_json:
+            response = self.client.get('/api/chart/', {'period': '1y'}, HTTP_IF_NONE_MATCH=etag)
+        assert response.status_code == 304
+        assert response.content == b''
+        assert response['ETag'] == etag
+        assert not os_module.stat.called and not open_file.called and not dump_json.called
+
+    def test_changed_chart_returns_new_body(self):
+        etag = self.client.get('/api/chart/')['ETag']
+        self.write('chart.csv', CHART_CSV.replace('99.25', '98'))
+        response = self.client.get('/api/chart/', HTTP_IF_NONE_MATCH=etag)
+        assert response.status_code == 200
+        assert response['ETag'] != etag
+
+    def test_if_modified_since(self):
+        last_modified = self.client.get('/api/stats/')['Last-Modified']
+        response = self.client.get('/api/stats/', HTTP_IF_MODIFIED_SINCE=last_modified)
+        assert response.status_code == 304
+
+    def test_gzipped_body_is_served_when_accepted(self):
+        plain = self.client.get('/api/chart/')
+        response = self.client.get('/api/chart/', HTTP_ACCEPT_ENCODING='gzip, deflate')
+        assert response['Content-Encoding'] == 'gzip'
+        assert gzip.decompress(response.content) == plain.content
+        assert response['ETag'] != plain['ETag']
+        assert charts.chart_payload('ALL').gzipped is charts.chart_payload('ALL').gzipped
+
+
+class ChartStoreTestCase(ChartFilesMixin, APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.store_path = os.path.join(self.directory, 'chart.bin')
+        call_command('build_chart_store', '--output', self.store_path, stdout=StringIO())
+        charts.stores.files.clear()
+
+    def test_store_serves_the_same_chart_and_stats(self):
+        expected = [self.client.get(path).content for path in ('/api/chart/', '/api/stats/')]
+        cache.clear()
+        with self.settings(PATH_TO_CHART_STORE=self.store_path):
+            assert [self.client.get(path).content for path in ('/api/chart/', '/api/stats/')] == expected
+
+    def test_store_is_memory_mapped(self):
+        _, chart = charts.read_store(self.store_path)
+        assert chart.labels.tolist() == [1420156800, 1420416000, 1420502400]
+        assert chart.titan.tolist() == [100, 101.5, 99.25]
+        assert not chart.labels.flags.writeable and not chart.titan.flags.owndata
+        assert np.shares_memory(chart.select(1, 3)[1], chart.titan)
+
+    def test_invalid_store_is_rejected(self):
+        path = self.write('chart.bin', 'not a chart store, just text')
+        with self.assertRaises(ValueError):
+            charts.read_store(path)
+
+    def test_compact_chart_is_negotiated(self):
+        response = self.client.get('/api/chart/', HTTP_ACCEPT=charts.COMPACT_MEDIA_TYPE)
+        assert response['Content-Type'] == charts.COMPACT_MEDIA_TYPE
+        assert 'Accept' in response['Vary']
+        data = json.loads(response.content.decode())
+        assert data['length'] == 3
+        labels = np.frombuffer(base64.b64decode(data['labels']), '<i8')
+        assert labels.tolist() == [1420156800, 259200, 86400]
+        assert np.cumsum(labels).tolist() == [1420156800, 1420416000, 1420502400]
+        assert np.frombuffer(base64.b64decode(data['titan']), '<f4').tolist() == [100, 101.5, 99.25]
+        assert np.frombuffer(base64.b64decode(data['sp500']), '<f4').tolist() == [100, 98.5, 97]
+        assert response['ETag'] != self.client.get('/api/chart/')['ETag']
+
+    def test_compact_labels_before_1970(self):
+        self.write('chart.csv', 'Date,12/31/1964,01/02/1965,01/04/1965\nTitan,100,101,102\nS&P 500,100,99,98\n')
+        data = json.loads(self.client.get('/api/chart/', {'format': 'compact'}).content.decode())
+        labels = np.cumsum(np.frombuffer(base64.b64decode(data['labels']), '<i8'))
+        assert labels.tolist() == [-157852800, -157680000, -157507200]
+        assert labels.tolist() == json.loads(self.client.get('/api/chart/').content.decode())['labels']
+
+    def test_json_stays_the_default(self):
+        for headers in ({'HTTP_ACCEPT': 'application/json'}, {'HTTP_ACCEPT': '*/*'}, {}):
+            response = self.client.get('/api/chart/', **headers)
+            assert response['Content-Type'] == 'application/json'
+            assert json.loads(response.content.decode())['titan'] == [100, 101.5, 99.25]
+
+
+class ChartPeriodTestCase(ChartFilesMixin, APITestCase):
+    def setUp(self):
+        super().setUp()
+        # every day from 01/01/2000 to 06/30/2017, Titan grows by one each day and S&P 500 alternates
+        days = [datetime.date(2000, 1, 1) + timedelta(days=i) for i in range(6391)]
+        rows = [
+            ['Date'] + [day.strftime('%m/%d/%Y') for day in days],
+            ['Titan'] + [str(i) for i in range(len(days))],
+            ['S&P 500'] + [str(i % 2) for i in range(len(days))],
+        ]
+        self.write('chart.csv', '\n'.join(','.join(row) for row in rows))
+
+    def get_chart(self, **params):
+        response = self.client.get('/api/chart/', params)
+        assert response.status_code == 200, response.content
+        return json.loads(response.content.decode())
+
+    def first_day(self, chart):
+        return datetime.datetime.utcfromtimestamp(chart['labels'][0]).date()
+
+    def test_periods_are_sliced_from_master_series(self):
+        assert self.first_day(self.get_chart(period='all')) == datetime.date(2000, 1, 1)
+        assert self.first_day(self.get_chart(period='ytd')) == datetime.date(2017, 1, 1)
+        assert self.first_day(self.get_chart(period='1y')) == datetime.date(2016, 6, 30)
+        assert self.first_day(self.get_chart(period='10y')) == datetime.date(2007, 6, 30)
+        assert len(self.get_chart(period='ytd')['labels']) == 181
+
+    def test_arbitrary_range(self):
+        start = charts.to_timestamp(datetime.date(2010, 3, 1))
+        end = charts.to_timestamp(datetime.date(2010, 3, 10))
+        chart = self.get_chart(**{'from': start, 'to': end})
+        assert chart['labels'][0] == start
+        assert chart['labels'][-1] == end
+        assert len(chart['titan']) == len(chart['sp500']) == 10
+
+    def test_invalid_range_returns_400(self):
+        assert self.client.get('/api/chart/', {'from': 10, 'to': 5}).status_code == 400
+        assert self.client.get('/api/chart/', {'from': 'yesterday'}).status_code == 400
+
+    def test_downsampling_keeps_endpoints_and_caps_points(self):
+        full = self.get_chart()
+        chart = self.get_chart(points=100)
+        assert len(chart['labels']) == len(chart['titan']) == len(chart['sp500']) == 100
+        assert chart['labels'][0] == full['labels'][0]
+        assert chart['labels'][-1] == full['labels'][-1]
+        assert chart['labels'] == sorted(chart['labels'])
+
+    def test_downsampling_keeps_spikes(self):
+        x = np.arange(1000)
+        y = np.zeros(1000)
+        y[437] = 50
+        assert 437 in charts.downsample(x, (y,), 10)
+
+    def test_too_few_points_returns_400(self):
+        assert self.client.get('/api/chart/', {'points': 2}).status_code == 400
+
+
+class SharedCacheTestCase(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.calls = 0
+
+    def compute(self, value='fresh', delay=0):
+        def compute():
+            self.calls += 1
+            time.sleep(delay)
+            return value
+        return compute
+
+    def test_value_is_computed_once(self):
+        assert shared_cache.get_or_compute('key', self.compute(), ttl=60) == 'fresh'
+        assert shared_cache.get_or_compute('key', self.compute('other'), ttl=60) == 'fresh'
+        assert self.calls == 1
+
+    def test_concurrent_misses_compute_once(self):
+        results = []
+        compute = self.compute(delay=0.2)
+        threads = [threading.Thread(target=lambda: results.append(shared_cache.get_or_compute('key', compute, ttl=60)))
+                   for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert results == ['fresh'] * 8
+        assert self.calls == 1
+
+    def test_stale_value_is_served_while_another_request_refreshes(self):
+        cache.set('key', ('stale', time.time() - 1), 60)
+        cache.add('key' + shared_cache.LOCK_SUFFIX, True, 10)
+        assert shared_cache.get_or_compute('key', self.compute(), ttl=60, stale_ttl=60) == 'stale'
+        assert self.calls == 0
+
+    def test_stale_value_is_refreshed_by_one_request(self):
+        cache.set('key', ('stale', time.time() - 1), 60)
+        assert shared_cache.get_or_compute('key', self.compute(), ttl=60, stale_ttl=60) == 'fresh'
+        assert shared_cache.get_or_compute('key', self.compute('other'), ttl=60, stale_ttl=60) == 'fresh'
+        assert self.calls == 1
+        assert cache.get('key' + shared_cache.LOCK_SUFFIX) is None
+
+    def test_lock_is_released_when_computation_fails(self):
+        def fail():
+            raise ValueError
+        with self.assertRaises(ValueError):
+            shared_cache.get_or_compute('key', fail, ttl=60)
+        assert shared_cache.get_or_compute('key', self.compute(), ttl=60) == 'fresh'
+
+    def test_chart_bodies_are_shared_between_workers(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.csv') as chart_file:
+            chart_file.write(CHART_CSV)
+            chart_file.flush()
+            with self.settings(PATH_TO_CSV_CHART=chart_file.name):
+                charts.charts.files.clear()
+                body = charts.chart_payload('ALL').body
+                # another worker: its own parsed copy, same shared cache
+                charts.charts.files.clear()
+                with mock.patch('referrals.charts.dump_json') as dump_json:
+                    assert charts.chart_payload('ALL').body == body
+                assert not dump_json.called
@@ -0,0 +1,42 @@
+"""
+Tree stats kept on every user: `depth` is set when the user joins, but `descendant_count` of the
+ancestors is raised later and in batches. Raising it on every join would update every ancestor up
+to the root, so joins anywhere under a popular root would wait for each other's lock on its row and
+drop its cached payload each time. A join only queues its referral_path as a PendingDescendant, and
+`manage.py count_descendants` flushes the queue, so descendant counts lag by up to its --interval.
+"""
+from collections import Counter, defaultdict
+
+from django.db import transaction
+from django.db.models import F
+
+from referrals import cache as shared_cache
+from referrals.models import PendingDescendant, RegisteredUser
+
+
+def grouped_by_count(counts):
+    """
+    {id: count} as (count, [ids]) pairs, so every distinct increment is a single UPDATE.
+    """
+    groups = defaultdict(list)
+    for pk, count in counts.items():
+        groups[count].append(pk)
+    return groups.items()
+
+
+def add_descendants(descendants):
+    """
+    Raises the descendant_count of the users in `descendants` ({id: count}) and drops their cached payloads.
+    """
+    for count, ids in grouped_by_count(descendants):
+        RegisteredUser.objects.filter(pk__in=ids).update(descendant_count=F('descendant_count') + count)
+    for ancestor in RegisteredUser.objects.filter(pk__in=list(descendants)).only('email', 'referral_code'):
+        shared_cache.invalidate_user(ancestor)
+
+
+def flush_descendant_counts(batch_size=1000):
+    with transaction.atomic():
+        pending = list(PendingDescendant.objects.select_for_update(skip_locked=True).order_by('id')[:batch_size])
+        add_descendants(Counter(ancestor for entry in pending for ancestor in entry.ancestor_ids()))
+        PendingDescendant.objects.filter(pk__in=[entry.pk for entry in pending]).delete()
+    return len(pending)
@@ -1,14 +1,17 @@
 from django.conf.urls import url
 
-from referrals.views import UserViewSet, ChartViewSet, StatsViewSet
+from referrals.views import UserViewSet, ChartViewSet, ExportViewSet, LeaderboardViewSet, MetricsViewSet, StatsViewSet
 
 urlpatterns = [
-    url(r'join/$', UserViewSet.as_view({'post': 'register_new'})),
-    url(r'join/(?P<code>[\w]+)/$', UserViewSet.as_view({'post': 'register_from_referral'})),
+    url(r'join/$', UserViewSet.as_view({'post': 'register_new'}), name='join'),
+    url(r'join/(?P<code>[\w]+)/$', UserViewSet.as_view({'post': 'register_from_referral'}), name='join-referral'),
 
-    url(r'user/$', UserViewSet.as_view({'get': 'logged_in_details'})),
-    url(r'user/detail/$', UserViewSet.as_view({'get': 'retrieve_detail'})),
-    url(r'user/(?P<code>[\w]+)/$', UserViewSet.as_view({'get': 'retrieve', 'post': 'login'})),
-    url(r'chart/$', ChartViewSet.as_view({'get': 'retrieve'})),
-    url(r'stats/$', StatsViewSet.as_view({'get': 'retrieve'})),
+    url(r'user/$', UserViewSet.as_view({'get': 'logged_in_details', 'delete': 'logout'}), name='user'),
+    url(r'user/detail/$', UserViewSet.as_view({'get': 'retrieve_detail'}), name='user-detail'),
+    url(r'user/(?P<code>[\w]+)/$', UserViewSet.as_view({'get': 'retrieve', 'post': 'login'}), name='user-code'),
+    url(r'chart/$', ChartViewSet.as_view({'get': 'retrieve'}), name='chart'),
+    url(r'stats/$', StatsViewSet.as_view({'get': 'retrieve'}), name='stats'),
+    url(r'leaderboard/$', LeaderboardViewSet.as_view({'get': 'list'}), name='leaderboard'),
+    url(r'export/$', ExportViewSet.as_view({'get': 'retrieve'}), name='export'),
+    url(r'metrics/$', MetricsViewSet.as_view({'get': 'retrieve'}), name='metrics'),
 ]
@@ -1,67 +1,145 @@
-import random, string, calendar, datetime
+import re
+
 from django.conf import settings
-from django.core.mail import send_mail
-from django.db import transaction
+from django.db import DEFAULT_DB_ALIAS, IntegrityError, transaction
+from django.http import Http404, HttpResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404
-from django.template.loader import render_to_string
 from rest_framework import viewsets
 from rest_framework.exceptions import PermissionDenied, ValidationError
+from rest_framework.permissions import IsAdminUser
+from rest_framework.renderers import JSONRenderer
 from rest_framework.response import Response
-from django.utils.decorators import method_decorator
-from django.views.decorators.cache import cache_page
+from rest_framework.settings import api_settings
+from rest_framework.validators import UniqueValidator
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date
 
-from referrals.models import RegisteredUser
+from referrals import cache as shared_cache, charts, emails, export, leaderboard, metrics, ranking, sessions
+from referrals.models import CounterShard, RegisteredUser
 from referrals.serializers import UserReferralSerializer, RegistrationSerializer
 
-
-import csv
+ACCEPTS_GZIP = re.compile(r'\bgzip\b')
+
+
+class CompactChartRenderer(JSONRenderer):
+    """
+    Lets clients ask for compact charts with `Accept` (or `?format=compact`). The chart itself is
+    encoded by charts.Chart.as_compact, only errors go through this renderer.
+    """
+    media_type = charts.COMPACT_MEDIA_TYPE
+    format = 'compact'
+
+
+def payload_response(request, payload, content_type='application/json'):
+    """
+    Serves a precomputed charts.Payload, gzipped when the client accepts it. Conditional requests
+    are answered with 304 before the body is even looked at.
+    """
+    gzipped = bool(ACCEPTS_GZIP.search(request.META.get('HTTP_ACCEPT_ENCODING', '')))
+    etag = payload.etag[:-1] + '-gzip"' if gzipped else payload.etag
+    response = get_conditional_response(request, etag=etag, last_modified=payload.last_modified)
+    if response is None:
+        response = HttpResponse(payload.gzipped if gzipped else payload.body, content_type=content_type)
+        if gzipped:
+            response['Content-Encoding'] = 'gzip'
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(payload.last_modified)
+    patch_vary_headers(response, ('Accept-Encoding',))
+    return response
+
+
+def total_registered():
+    """
+    The same for every user payload, so it is cached once and only for a few seconds.
+    """
+    return shared_cache.get_or_compute(
+        'referrals:total_registered', lambda: CounterShard.get_value(CounterShard.TOTAL_REGISTERED),
+        getattr(settings, 'TOTAL_REGISTERED_TTL', 5), stale_ttl=getattr(settings, 'TOTAL_REGISTERED_STALE_TTL', 60))
+
+
+def user_payload(data):
+    """
+    The wait-list position shown is the user's place in the queue, which unlike the stored position
+    has no gaps and, in the referral ranking mode, is boosted by their referrals.
+    """
+    data['wait_list_position'] = ranking.wait_list_rank(data['wait_list_position'], data['referral_count'])
+    return data
 
 
 class ChartViewSet(viewsets.ViewSet):
-    @method_decorator(cache_page(60))
+    renderer_classes = api_settings.DEFAULT_RENDERER_CLASSES + [CompactChartRenderer]
+
     def retrieve(self, request):
+        period, start, end = self.get_range(request)
+        points = self.get_int_param(request, 'points')
+        if points is not None and points < 3:
+            raise ValidationError('points must be at least 3')
+        compact = request.accepted_renderer.format == CompactChartRenderer.format
+        response = payload_response(request, charts.chart_payload(period, start, end, points, compact),
+                                    charts.COMPACT_MEDIA_TYPE if compact else 'application/json')
+        patch_vary_headers(response, ('Accept',))
+        return response
+
+    @classmethod
+    def get_range(cls, request):
         period = request.query_params.get('period', 'ALL')
         period = period.upper()
-        if period in ['1Y', '3Y', '5Y', '10Y', 'YTD', 'ALL']:
-            return Response(self.get_chart_from_file(period))
-        else:
+        if period not in charts.PERIODS:
             raise ValidationError('Invalid period specified')
+        start = cls.get_int_param(request, 'from')
+        end = cls.get_int_param(request, 'to')
+        if start is not None and end is not None and start > end:
+            raise ValidationError('from must not be after to')
+        return period, start, end
+
+    @staticmethod
+    def get_int_param(request, name):
+        value = request.query_params.get(name)
+        if value is None:
+            return None
+        try:
+            return int(value)
+        except ValueError:
+            raise ValidationError('{} must be an integer'.format(name))
 
-    def get_chart_from_file(self, period):
-        files_map = {
-            'YTD': settings.PATH_TO_CSV_CHART_YTD,
-            '1Y': settings.PATH_TO_CSV_CHART_1Y,
-            '3Y': settings.PATH_TO_CSV_CHART_3Y,
-            '5Y': settings.PATH_TO_CSV_CHART_5Y,
-            '10Y': settings.PATH_TO_CSV_CHART_10Y,
-            'ALL': settings.PATH_TO_CSV_CHART_ALL,
-        }
-
-        reader = csv.reader(open(files_map[period]))
-        labels = next(reader)[1:]
-        titan_data = next(reader)[1:]
-        sp500_data = next(reader)[1:]
-        return {
-            'labels': [calendar.timegm(datetime.datetime.strptime(l, '%m/%d/%Y').timetuple()) for l in labels],
-            'titan': list(map(float, titan_data)),
-            'sp500': list(map(float, sp500_data)),
-        }
 
 class StatsViewSet(viewsets.ViewSet):
-    @method_decorator(cache_page(60))
     def retrieve(self, request):
-        return Response(self.get_stats_from_file())
+        return payload_response(request, charts.stats_payload(*ChartViewSet.get_range(request)))
+
+
+class LeaderboardViewSet(viewsets.ViewSet):
+    def list(self, request):
+        limit = ChartViewSet.get_int_param(request, 'limit')
+        if limit is None:
+            limit = 20
+        if not 1 <= limit <= getattr(settings, 'LEADERBOARD_PAGE_SIZE_MAX', 100):
+            raise ValidationError('limit is out of range')
+        try:
+            entries, cursor = leaderboard.page(limit, request.query_params.get('cursor'))
+        except leaderboard.InvalidCursor:
+            raise ValidationError('Invalid cursor')
+        return Response({'results': entries, 'next': cursor})
+
+
+class ExportViewSet(viewsets.ViewSet):
+    permission_classes = (IsAdminUser,)
+
+    def retrieve(self, request):
+        # not `format`, which DRF uses to pick a renderer
+        output_format = request.query_params.get('output', 'csv')
+        if output_format not in export.FORMATS:
+            raise ValidationError('Invalid output format')
+        response = StreamingHttpResponse(export.lines(output_format), content_type=export.CONTENT_TYPES[output_format])
+        response['Content-Disposition'] = 'attachment; filename="waitlist.{}"'.format(output_format)
+        return response
+
 
-    def get_stats_from_file(self):
-        reader = csv.reader(open(settings.PATH_TO_CSV_STATS))
-        labels = next(reader)[1:]
-        titan_data = next(reader)[1:]
-        sp500_data = next(reader)[1:]
-        return [{
-                'label': labels[i],
-                'titan': float(titan_data[i]),
-                'sp500': float(sp500_data[i]),
-            } for i in range(len(labels))]
+class MetricsViewSet(viewsets.ViewSet):
+    permission_classes = (metrics.CanReadMetrics,)
+
+    def retrieve(self, request):
+        return HttpResponse(metrics.render_all(), content_type=metrics.CONTENT_TYPE)
 
 
 class UserViewSet(viewsets.ViewSet):
@@ -69,98 +147,94 @@ class UserViewSet(viewsets.ViewSet):
     serializer_class = UserReferralSerializer
 
     def logged_in_details(self, request, *args, **kwargs):
-        email = request.session.get('email')
-        if email:
-            user = get_object_or_404(RegisteredUser, email=email)
-            return Response(UserReferralSerializer(user).data)
-        raise PermissionDenied
+        if not sessions.enabled():
+            email = request.session.get('email')
+            if email:
+                return Response(self.get_user_data(email=email))
+            raise PermissionDenied
+
+        user, reissue = sessions.token_user(request)
+        if user is None:
+            raise PermissionDenied
+        response = Response(user_payload(dict(UserReferralSerializer(user).data, total_registered=total_registered())))
+        if reissue:
+            sessions.set_token(response, user)
+        return response
+
+    def logout(self, request, *args, **kwargs):
+        """
+        In token mode this revokes every token of the user, logging them out everywhere.
+        """
+        response = Response(status=204)
+        sessions.log_out(request, response)
+        return response
 
     def retrieve(self, request, code, *args, **kwargs):
-        user = get_object_or_404(RegisteredUser, referral_code=code)
-        return Response(UserReferralSerializer(user).data)
+        return Response(self.get_user_data(referral_code=code))
 
     def retrieve_detail(self, request, *args, **kwargs):
         email = request.query_params.get('email', None)
         code = request.query_params.get('code', None)
         if email:
-            user = get_object_or_404(RegisteredUser, email=email)
-            return Response(UserReferralSerializer(user).data)
+            return Response(self.get_user_data(email=email))
         if code:
-            user = get_object_or_404(RegisteredUser, referral_code=code)
-            return Response(UserReferralSerializer(user).data)
+            return Response(self.get_user_data(referral_code=code))
 
         raise ValidationError('Either email or code must be specified')
 
     def login(self, request, code, *args, **kwargs):
-        user = get_object_or_404(RegisteredUser, referral_code=code)
-        request.session['email'] = user.email
-        return Response(UserReferralSerializer(user).data)
+        data = self.get_user_data(referral_code=code)
+        response = Response(data)
+        sessions.log_in(request, response, data['email'])
+        return response
 
 
     @transaction.atomic
     def register_new(self, request):
         registration_data = RegistrationSerializer(data=request.data)
         registration_data.is_valid(raise_exception=True)
-        user, created = RegisteredUser.objects.get_or_create(email=registration_data.validated_data['email'])
-        if created:
-            user.referral_code = self.generate_referral_code()
-            user.save()
-            self.notify_user_with_email(request.build_absolute_uri('/'), user.referral_code, user.email)
-        request.session['email'] = user.email
-        return Response(UserReferralSerializer(user).data)
+        user = self.register(registration_data.validated_data['email'])
+        emails.notify_user(request.build_absolute_uri('/'), user.referral_code, user.email)
+        response = Response(user_payload(UserReferralSerializer(user).data))
+        sessions.log_in(request, response, user.email, user)
+        return response
 
     @transaction.atomic
     def register_from_referral(self, request, code):
-        referred_by = get_object_or_404(RegisteredUser, referral_code=code)
         registration_data = RegistrationSerializer(data=request.data)
-        registration_data.is_valid(raise_exception=True)
-        user, created = RegisteredUser.objects.get_or_create(email=registration_data.validated_data['email'])
-        if created:
-            user.referred_by = referred_by
-            user.referral_code = self.generate_referral_code()
-            user.save()
-            self.notify_user_with_email(request.build_absolute_uri('/'), user.referral_code, user.email)
-            self.notify_referrer_with_email(request.build_absolute_uri('/'), referred_by.email)
-        request.session['email'] = user.email
-        return Response(UserReferralSerializer(user).data)
+        if not registration_data.is_valid():
+            if not RegisteredUser.objects.filter(referral_code=code).exists():
+                raise Http404
+            raise ValidationError(registration_data.errors)
+        user = self.register(registration_data.validated_data['email'], referrer_code=code)
+        emails.notify_user(request.build_absolute_uri('/'), user.referral_code, user.email)
+        emails.notify_referrer_of_signup(request.build_absolute_uri('/'), user.referred_by)
+        shared_cache.invalidate_user(user.referred_by)
+        response = Response(user_payload(UserReferralSerializer(user).data))
+        sessions.log_in(request, response, user.email, user)
+        return response
 
     @staticmethod
-    def generate_referral_code(code_length=8):
-        code = ''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(code_length))
-        while RegisteredUser.objects.filter(referral_code=code).exists():
-            code = ''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(code_length))
-        return code
-
-
-    @staticmethod
-    def notify_user_with_email(base_url, referral_code, email):
-        template_html = 'email-titan-template.html'
-        template_text = 'email-titan-template.txt'
-
-        context = {'url': '{}#!/{}'.format(base_url, referral_code),
-                   'logo_url': '{}/images/Titan_logo.png'.format(base_url)}
-        plain_msg = render_to_string(template_text, context)
-        html_msg = render_to_string(template_html, context)
-        send_mail(subject='Welcome to Titan!',
-                  message=plain_msg,
-                  html_message=html_msg,
-                  from_email=settings.DEFAULT_FROM_EMAIL,
-                  recipient_list=[email],
-                  fail_silently=False)
-
+    def register(email, referrer_code=None):
+        try:
+            return RegisteredUser.objects.register(email, referrer_code=referrer_code)
+        except RegisteredUser.DoesNotExist:
+            raise Http404
+        except IntegrityError:
+            raise ValidationError({'email': [UniqueValidator.message]})
 
     @staticmethod
-    def notify_referrer_with_email(base_url, email):
-        template_html = 'email-titan-template-after-signup.html'
-        template_text = 'email-titan-template-after-signup.txt'
-
-        context = {'status_url': '{}#!/check-status/{}'.format(base_url, email),
-                   'logo_url': '{}/images/Titan_logo.png'.format(base_url)}
-        plain_msg = render_to_string(template_text, context)
-        html_msg = render_to_string(template_html, context)
-        send_mail(subject='Thank you!',
-                  message=plain_msg,
-                  html_message=html_msg,
-                  from_email=settings.DEFAULT_FROM_EMAIL,
-                  recipient_list=[email],
-                  fail_silently=False)
+    def get_user_data(**lookup):
+        """
+        User payload for a single `field=value` lookup. Everything but total_registered comes from
+        the user cache, which is invalidated whenever the user's row changes.
+        """
+        (field, value), = lookup.items()
+        data = shared_cache.get_user(field, value)
+        if data is None or data == shared_cache.CHANGED:
+            # right after a change, replicas may still have the old row
+            changed = data == shared_cache.CHANGED
+            users = RegisteredUser.objects.using(DEFAULT_DB_ALIAS) if changed else RegisteredUser.objects
+            data = UserReferralSerializer(get_object_or_404(users, **lookup)).data
+            shared_cache.set_user(data)
+        return user_payload(dict(data, total_registered=total_registered()))
@@ -45,7 +45,9 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE_CLASSES = [
+    'referrals.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
+    'referrals.routers.ReplicaPinningMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -88,8 +90,73 @@ DATABASES = {
         'PASSWORD': 'postgres',
         'HOST': '127.0.0.1',
         'PORT': 5432,
+    },
+    # A streaming replica of 'default', listed in DATABASE_REPLICAS:
+    # 'replica': {
+    #     'ENGINE': 'django.db.backends.postgresql',
+    #     'NAME': 'titan-db',
+    #     'USER': 'postgres',
+    #     'PASSWORD': 'postgres',
+    #     'HOST': '10.0.0.2',
+    #     'PORT': 5432,
+    # },
+}
+# 'database' keeps who is logged in in django.contrib.sessions, 'token' in a signed token (cookie or
+# Authorization: Bearer header) without any session table I/O, see referrals.sessions
+SESSION_MODE = 'database'
+SESSION_TOKEN_COOKIE_NAME = 'titan_token'
+SESSION_TOKEN_MAX_AGE = 14 * 24 * 3600
+SESSION_TOKEN_ROTATE_AFTER = 24 * 3600
+# New tokens are signed with the first key, tokens signed with any of them are accepted (and reissued)
+SESSION_TOKEN_KEYS = [SECRET_KEY]
+
+# Aliases of DATABASES that serve reads, see referrals.routers
+DATABASE_REPLICAS = []
+DATABASE_ROUTERS = ['referrals.routers.PrimaryReplicaRouter']
+# Seconds a client keeps reading from the primary after a write
+REPLICA_PIN_SECONDS = 5
+
+# Per-route latency, SQL and template metrics at /api/metrics/, see referrals.metrics
+METRICS_ENABLED = True
+# Fraction of requests whose SQL statements are counted and timed
+METRICS_SQL_SAMPLE_RATE = 0.1
+# Addresses (REMOTE_ADDR) allowed to read /api/metrics/ without logging in as staff, e.g. the Prometheus server
+METRICS_ALLOWED_IPS = []
+
+
+# Cache shared by all gunicorn workers of a node. With several nodes, or for atomic single-flight
+# locks, use a Redis backend instead, e.g.
+# {'BACKEND': 'django_redis.cache.RedisCache', 'LOCATION': 'redis://127.0.0.1:6379/1'}
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': '/var/tmp/titan-cache',
     }
 }
+SHARED_CACHE_ALIAS = 'default'
+# Seconds serialized chart and stats bodies are kept in the shared cache
+CHART_CACHE_TTL = 3600
+# Seconds a user payload is cached; entries are also dropped as soon as the user changes
+USER_CACHE_TTL = 300
+# total_registered shown in user payloads may lag by up to this many seconds (and is served stale for
+# up to TOTAL_REGISTERED_STALE_TTL more while one request refreshes it)
+TOTAL_REGISTERED_TTL = 5
+TOTAL_REGISTERED_STALE_TTL = 60
+
+# 'signup' shows users their sign-up order, 'referrals' moves them WAIT_LIST_REFERRAL_BOOST places up
+# the queue for every referral
+WAIT_LIST_RANKING = 'signup'
+WAIT_LIST_REFERRAL_BOOST = 10
+# Seconds between two checks of a worker's ranking for registrations made by other workers
+WAIT_LIST_RANK_SYNC_INTERVAL = 1
+
+# /api/leaderboard/ pages through a snapshot of the top LEADERBOARD_SIZE referrers taken every
+# LEADERBOARD_TTL seconds; cursors keep their snapshot for LEADERBOARD_CURSOR_TTL more seconds
+LEADERBOARD_SIZE = 1000
+LEADERBOARD_TTL = 60
+LEADERBOARD_CURSOR_TTL = 600
+LEADERBOARD_PAGE_SIZE_MAX = 100
 
 
 # Password validation
@@ -132,14 +199,24 @@ STATIC_ROOT = os.path.join(BASE_DIR, '/static/')
 STATIC_URL = '/static/'
 
 CSV_DIR = os.path.join(BASE_DIR, 'charts')
+# Master series, every chart period is sliced out of it
 PATH_TO_CSV_CHART = os.path.join(CSV_DIR, 'titan-chart.csv')
-PATH_TO_CSV_CHART_YTD = os.path.join(CSV_DIR, 'titan-chart-ytd.csv')
-PATH_TO_CSV_CHART_1Y = os.path.join(CSV_DIR, 'titan-chart-1y.csv')
-PATH_TO_CSV_CHART_3Y = os.path.join(CSV_DIR, 'titan-chart-3y.csv')
-PATH_TO_CSV_CHART_5Y = os.path.join(CSV_DIR, 'titan-chart-5y.csv')
-PATH_TO_CSV_CHART_10Y = os.path.join(CSV_DIR, 'titan-chart-10y.csv')
-PATH_TO_CSV_CHART_ALL = os.path.join(CSV_DIR, 'titan-chart-all.csv')
-PATH_TO_CSV_STATS = os.path.join(CSV_DIR, 'titan-stats.csv')
+# Binary copy of PATH_TO_CSV_CHART written by `manage.py build_chart_store`. When set, workers serve charts
+# from this file (memory-mapped, so its pages are shared) and the CSV file is not read.
+PATH_TO_CHART_STORE = None
+# Annual risk-free rate (a fraction) the Sharpe ratio of /api/stats/ is computed against
+STATS_RISK_FREE_RATE = 0
+
+# Number of rows each sharded counter (e.g. total_registered) is split into.
+COUNTER_SHARDS = 8
+
+# Serialized chart ranges kept in memory per worker
+CHART_PAYLOAD_CACHE_SIZE = 256
+# Seconds between checks whether the chart file changed on disk
+CHART_RELOAD_INTERVAL = 1
+
+# Key of the permutation turning wait-list positions into referral codes. Changing it only affects new codes.
+REFERRAL_CODE_KEY = SECRET_KEY
 
 if DEBUG:
     CORS_ORIGIN_ALLOW_ALL = True
@@ -152,3 +229,13 @@ EMAIL_PORT = 0
 EMAIL_HOST_PASSWORD = ''
 EMAIL_HOST_USER = ''
 EMAIL_USE_TLS = True
+
+# Outbox drained by `manage.py send_outbox`
+EMAIL_OUTBOX_BATCH_SIZE = 50
+EMAIL_OUTBOX_MAX_ATTEMPTS = 8
+EMAIL_OUTBOX_RETRY_DELAY = 60
+EMAIL_OUTBOX_MAX_RETRY_DELAY = 3600
+
+# When non-zero, referrers get one email per this many seconds with the number of friends who joined,
+# instead of one email per referral.
+REFERRER_DIGEST_WINDOW = 0
@@ -14,3 +14,8 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "titan.settings")
 
 application = get_wsgi_application()
+
+# Parse the chart file and load the wait list ranking before the first request reaches this worker.
+from referrals import charts, ranking
+charts.warm_up()
+ranking.warm_up()